@@ -0,0 +1,56 @@
+print("Running benchmarks")
+import random
+import sys
+import time
+
+import main
+
+np = main.np
+
+
+def bench_projection(points: int = 100000) -> None:
+    # Per-point wgs2pixel against batch wgs2pixels, on points around Moscow.
+    frag = (8, 55.75, 37.62)
+    tile_range = main.get_image_tile_range(frag[1], frag[2], frag[0])
+    coords = [(frag[1] + random.uniform(-1, 1), frag[2] + random.uniform(-2, 2)) for i in range(points)]
+
+    start = time.perf_counter()
+    per_point = [main.wgs2pixel(coord, tile_range, frag) for coord in coords]
+    per_point_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    batch = main.wgs2pixels(np.array(coords), tile_range, frag)
+    batch_time = time.perf_counter() - start
+
+    assert np.round(batch).astype(int).tolist() == [list(coord) for coord in per_point]
+    print(f"Projection of {points} points:")
+    print(f"  wgs2pixel   {per_point_time * 1000:>8.1f} ms")
+    print(f"  wgs2pixels  {batch_time * 1000:>8.1f} ms  ({per_point_time / batch_time:.0f}x faster)")
+
+
+def bench_render_queue(segments: int = 2000, length: int = 50) -> None:
+    # Lists of tuples against Segments, for bounds and memory use.
+    lists = [[(random.uniform(-90, 90), random.uniform(-180, 180)) for i in range(length)] for j in range(segments)]
+    queue = main.Segments.from_lists(lists)
+    list_bytes = sys.getsizeof(lists) + sum(
+        sys.getsizeof(segment) + sum(sys.getsizeof(c) + 2 * sys.getsizeof(c[0]) for c in segment) for segment in lists
+    )
+    queue_bytes = queue.coords.nbytes + queue.offsets.nbytes
+
+    start = time.perf_counter()
+    lats, lons = [c[0] for s in lists for c in s], [c[1] for s in lists for c in s]
+    list_bounds = (min(lats), max(lats), min(lons), max(lons))
+    list_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    queue_bounds = main.get_render_queue_bounds(queue)
+    queue_time = time.perf_counter() - start
+
+    assert queue_bounds == tuple(round(b, 5) for b in list_bounds)
+    print(f"Render queue of {segments * length} points:")
+    print(f"  lists     {list_bytes / 1024:>8.0f} KiB {list_time * 1000:>8.1f} ms")
+    print(f"  Segments  {queue_bytes / 1024:>8.0f} KiB {queue_time * 1000:>8.1f} ms")
+
+
+bench_projection()
+bench_render_queue()
@@ -2,23 +2,35 @@
 from __future__ import annotations
 
 import asyncio
+import copy
 import functools
+import hashlib
+import itertools
 import json
 import math
 import os
 import random
 import re
+import sqlite3
 import time
+from collections import Counter
+from collections import deque
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from contextlib import contextmanager
 from datetime import datetime
+from email.utils import parsedate_to_datetime
 from io import BytesIO
 from multiprocessing import Pool
 from typing import Any
 from typing import Iterable
 from typing import Union
 from urllib.parse import quote
+from urllib.parse import urlsplit
 
 import aiohttp
 import discord
+import numpy as np
 import overpy
 import requests
 from discord import AllowedMentions
@@ -58,8 +70,6 @@ USER_INLINE_REGEX = rf"{SS}user\/[\w\-_]+{SE}"
 MAP_FRAGMENT_INLINE_REGEX = rf"{SS}#map={POS_INT}\/{DECIMAL}\/{DECIMAL}{SE}"
 MAP_FRAGEMT_CAPTURING_REGEX = rf"#map=({POS_INT})\/({DECIMAL})\/({DECIMAL})"
 
-# This global set contains filename similar to /fate. If on_message fails, it will remove cached files on next run.
-cached_files: set = set()
 # Set of unix timestamps.
 recent_fates: set = set()
 command_history: dict = dict()  # Global per-user dictionary of sets to keep track of rate-limiting per-user.
@@ -70,6 +80,7 @@ max_note_zoom = 17  # Maximum zoom, when notes are present on map.
 tile_w, tile_h = 256, 256  # Tile size used for renderer
 tiles_x, tiles_y = 5, 5  # Dimensions of output map fragment
 tile_margin_y, tile_margin_x = 0.1, 0.1  # How much free space is left at edges
+max_fallback_zoom_diff = 4  # How many zoom levels up to look for cached tile, when tile fails to download.
 # Used in render_elms_on_cluster. List of colours to be cycled.
 element_colors = ["#000", "#700", "#f00", "#070", "#0f0", "#f60"]
 
@@ -145,7 +156,18 @@ with open(config["ohno_file"], "r", encoding="utf8") as file:
 with open(config["josm_tips_file"], "r", encoding="utf8") as file:
     josm_tips = [entry for entry in file.read().split("\n\n") if entry != ""]
 
-client = Client(
+
+class OSMClient(Client):
+    async def close(self) -> None:
+        # Shared HTTP session belongs to the bot, so it goes down together with it.
+        if http_session is not None:
+            await http_session.close()
+        if render_pool is not None:
+            render_pool.terminate()
+        await super().close()
+
+
+client = OSMClient(
     intents=Intents.all(),
     allowed_mentions=AllowedMentions(
         # I also use checks elsewhere to prevent @ injection.
@@ -221,6 +243,241 @@ def user_to_mention(user: Member) -> str:
     return f"<@{user.id}>"
 
 
+class LRUCache(OrderedDict):
+    """Dictionary that forgets least recently used items once it holds more than `max_size` of them."""
+
+    def __init__(self, max_size: int) -> None:
+        super().__init__()
+        self.max_size = max_size
+
+    def get(self, key, default=None):
+        if key not in self:
+            return default
+        self.move_to_end(key)
+        return super().__getitem__(key)
+
+    def __setitem__(self, key, value) -> None:
+        super().__setitem__(key, value)
+        self.move_to_end(key)
+        while len(self) > self.max_size:
+            self.popitem(last=False)
+
+
+## METRICS ##
+# Counters and latency histograms since startup, shown by /stats.
+# Latencies are counted in logarithmic buckets, 20 per decade, so memory use doesn't grow over time.
+metric_counters: Counter[str] = Counter()
+metric_latencies: dict[str, Counter[int]] = {}
+BUCKETS_PER_DECADE = 20
+
+
+def count(name: str, amount: int = 1) -> None:
+    metric_counters[name] += amount
+
+
+def record_latency(name: str, seconds: float) -> None:
+    bucket = math.ceil(math.log10(max(seconds, 1e-4)) * BUCKETS_PER_DECADE)
+    metric_latencies.setdefault(name, Counter())[bucket] += 1
+
+
+@contextmanager
+def timed(name: str):
+    """Record how long the with-block took. Works just as well around awaits."""
+    t = time.time()
+    try:
+        yield
+    finally:
+        record_latency(name, time.time() - t)
+
+
+def latency_percentile(name: str, percentile: float) -> float:
+    """Upper estimate of given percentile of latency, in seconds."""
+    buckets = metric_latencies[name]
+    target = sum(buckets.values()) * percentile / 100
+    seen = 0
+    for bucket in sorted(buckets):
+        seen += buckets[bucket]
+        if seen >= target:
+            return 10 ** (bucket / BUCKETS_PER_DECADE)
+    return 0.0
+
+
+## HTTP ##
+# All outgoing traffic (tiles, OSM API, taginfo...) goes through one long-lived session,
+# so connections, TLS handshakes and DNS lookups get reused between requests.
+http_session: aiohttp.ClientSession | None = None
+JSON_HEADERS = {"Accept": "application/json"}
+RETRY_STATUSES = {429, 500, 502, 503, 504}  # Worth trying again after a while.
+
+
+def get_http_session() -> aiohttp.ClientSession:
+    """Shared HTTP session. Created on first use, because it must be made inside running event loop."""
+    global http_session
+    if http_session is None or http_session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=config["http"]["max_connections"],
+            limit_per_host=config["http"]["max_connections_per_host"],
+            ttl_dns_cache=config["http"]["dns_cache_ttl"],
+            keepalive_timeout=config["http"]["keepalive_timeout"],
+        )
+        timeout = aiohttp.ClientTimeout(total=config["http"]["timeout"], connect=config["http"]["connect_timeout"])
+        http_session = aiohttp.ClientSession(connector=connector, headers=HEADERS, timeout=timeout)
+    return http_session
+
+
+### Request coalescing ###
+# When same link is posted few times in a row, identical requests would be sent at the same time.
+# Instead, everyone waits for the first one. Results must be immutable (bytes, tuples), because they are shared.
+in_flight: dict[Any, asyncio.Future] = {}
+
+
+async def single_flight(key, coro_func, *args):
+    """Await `coro_func(*args)`, unless call with same key is already running. Then share its result."""
+    if key not in in_flight:
+        task = asyncio.ensure_future(coro_func(*args))
+        in_flight[key] = task
+        task.add_done_callback(lambda _: in_flight.pop(key, None))
+    # Shield, so one impatient caller being cancelled doesn't cancel it for everyone else.
+    return await asyncio.shield(in_flight[key])
+
+
+async def gather_bounded(*coros, limit: int = None) -> list:
+    """Like `asyncio.gather`, but at most `limit` coroutines run at once. Results keep their order."""
+    semaphore = asyncio.Semaphore(limit or config["inline_concurrency"])
+
+    async def run(coro):
+        async with semaphore:
+            return await coro
+
+    return await asyncio.gather(*(run(coro) for coro in coros))
+
+
+async def catch_lookup_error(elm_type: str, elm_id, coro) -> tuple[Any, list]:
+    """Await lookup, returning `(result, errorlog)`, so one failed item doesn't fail whole gather."""
+    try:
+        return await coro, []
+    except ValueError as error_message:
+        return None, [(elm_type, elm_id, error_message)]
+
+
+async def _http_get(url: str, headers: dict[str, str]) -> tuple[int, bytes]:
+    host = urlsplit(url).netloc
+    retries = config["http"]["retries"]
+    for attempt in range(retries + 1):
+        retry_after = 0.0
+        try:
+            with timed("http " + host):
+                async with get_http_session().get(url, headers=headers) as res:
+                    if res.status not in RETRY_STATUSES or attempt == retries:
+                        return res.status, await res.read()
+                    if res.headers.get("Retry-After", "").isdigit():
+                        retry_after = float(res.headers["Retry-After"])
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            if attempt == retries:
+                raise ValueError(f"Request to {host} failed ({e.__class__.__name__}).")
+        count("http retry")
+        # Exponential backoff with full jitter, so that many failed requests don't come back all at once.
+        await asyncio.sleep(max(retry_after, random.uniform(0, config["http"]["retry_delay"] * 2 ** attempt)))
+    raise ValueError(f"Request to {host} failed.")  # Not reachable, but keeps type checker happy.
+
+
+async def http_get(url: str, headers: dict[str, str] = JSON_HEADERS) -> tuple[int, bytes]:
+    """GET `url` using shared session, returns status code and body."""
+    return await single_flight(("GET", url, tuple(headers.items())), _http_get, url, headers)
+
+
+async def http_get_json(url: str) -> Any:
+    return json.loads((await http_get(url))[1])
+
+
+### Object cache ###
+# Same popular objects are looked up over and over. Entries are `(expires, object)`, where None means forever.
+# Objects are copied in and out, because embeds pop tags and comments they have already shown.
+object_cache = LRUCache(config["object_cache"]["size"])
+
+
+def object_ttl(kind: str, obj: dict, discussion: bool = False) -> float | None:
+    """How many seconds object can be cached for, None if it can't change anymore."""
+    ttls = config["object_cache"]
+    if kind == "changeset":
+        # Closed changesets are immutable, only their discussion goes on.
+        return ttls["open_ttl"] if obj.get("open", True) or discussion else None
+    elif kind == "note":
+        # Closed notes can be reopened, but rarely are.
+        return ttls["closed_note_ttl"] if obj["properties"]["status"] == "closed" else ttls["open_ttl"]
+    elif kind == "user":
+        return ttls["user_ttl"]
+    return ttls["element_ttl"]
+
+
+def get_cached_object(kind: str, key) -> Any:
+    """Cached object, or None if it isn't cached or has expired."""
+    entry = object_cache.get((kind, key))
+    if entry is not None and (entry[0] is None or entry[0] > time.time()):
+        count(kind + " cache hit")
+        return copy.deepcopy(entry[1])
+    count(kind + " cache miss")
+    return None
+
+
+def cache_object(kind: str, key, obj: Any, ttl: float | None) -> None:
+    object_cache[(kind, key)] = (None if ttl is None else time.time() + ttl, copy.deepcopy(obj))
+
+
+### Username index ###
+# Display name → uid, saved from every API response that has them, so most mentions resolve without any lookups.
+# Names that weren't found are remembered for a while too.
+def open_username_index(path: str) -> sqlite3.Connection:
+    if path != ":memory:":
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    db = sqlite3.connect(path)
+    with db:
+        # Name is unique, so saving it for a new uid deletes whoever had it before.
+        db.execute("CREATE TABLE IF NOT EXISTS usernames (uid INTEGER PRIMARY KEY, name TEXT UNIQUE, seen REAL)")
+        db.execute("CREATE TABLE IF NOT EXISTS missing_usernames (name TEXT PRIMARY KEY, error TEXT, checked REAL)")
+    return db
+
+
+username_db = open_username_index(config["username_index"]["file"])
+
+
+def usernames_in(obj: dict) -> list[tuple[int, str]]:
+    """`(uid, display name)` of element or changeset editor and everyone who commented it or a note."""
+    items = [obj] + obj.get("comments", []) + obj.get("properties", {}).get("comments", [])
+    return [(item["uid"], item["user"]) for item in items if "uid" in item and "user" in item]
+
+
+def remember_usernames(users: Iterable[tuple[int, str]]) -> None:
+    """Save current display names. A renamed user replaces their old name."""
+    now = time.time()
+    with username_db:
+        for uid, name in users:
+            username_db.execute("INSERT OR REPLACE INTO usernames VALUES (?, ?, ?)", (int(uid), name, now))
+            username_db.execute("DELETE FROM missing_usernames WHERE name = ?", (name,))
+
+
+def remember_missing_username(name: str, error: str) -> None:
+    with username_db:
+        username_db.execute("INSERT OR REPLACE INTO missing_usernames VALUES (?, ?, ?)", (name, error, time.time()))
+
+
+def indexed_user_id(name: str) -> int | None:
+    """uid of display name, None if it's not known. Raises ValueError if user recently wasn't found."""
+    row = username_db.execute("SELECT uid FROM usernames WHERE name = ?", (name,)).fetchone()
+    if row is not None:
+        count("username index hit")
+        return row[0]
+    row = username_db.execute(
+        "SELECT error FROM missing_usernames WHERE name = ? AND checked > ?",
+        (name, time.time() - config["username_index"]["missing_ttl"]),
+    ).fetchone()
+    if row is not None:
+        count("username index hit")
+        raise ValueError(row[0])
+    count("username index miss")
+    return None
+
+
 ## CLIENT ##
 
 
@@ -235,6 +492,8 @@ async def on_ready() -> None:
             pass
         print(f" - {guild.name}: {guild.id}")
     # print(" - " + "\n - ".join([f"{guild.name}: {guild.id}" for guild in client.guilds]))
+    # First check of taginfo also pre-warms its cache.
+    asyncio.ensure_future(check_taginfo_data_until())
 
 
 # I got annoyed by people using googlebad so often, so i implemented an easter egg.
@@ -279,6 +538,31 @@ async def quota_command(ctx: SlashContext) -> None:
     await ctx.send(msg, hidden=True)
 
 
+# Stats
+@slash.slash(
+    name="stats",
+    description="Shows latencies and cache statistics since startup.",
+    guild_ids=guild_ids,
+)  # type: ignore
+async def stats_command(ctx: SlashContext) -> None:
+    if not is_powerful(ctx.author, ctx.guild):
+        await ctx.send("You do not have permission to run this command.", hidden=True)
+        return
+    lines = [f"{'stage':<24}{'count':>7}{'p50':>9}{'p95':>9}{'p99':>9}"]
+    for name in sorted(metric_latencies):
+        lines.append(
+            f"{name:<24}{sum(metric_latencies[name].values()):>7}"
+            + "".join(f"{round(latency_percentile(name, p) * 1000):>7}ms" for p in (50, 95, 99))
+        )
+    lines.append("")
+    for name in sorted(metric_counters):
+        lines.append(f"{name:<31}{metric_counters[name]:>7}")
+        if name.endswith(" hit"):
+            total = metric_counters[name] + metric_counters[name.removesuffix("hit") + "miss"]
+            lines.append(f"{name.removesuffix(' hit') + ' ratio':<31}{metric_counters[name] / total:>7.0%}")
+    await ctx.send("```\n" + "\n".join(lines)[:1980] + "\n```", hidden=True)
+
+
 ### TagInfo ###
 @slash.slash(
     name="taginfo",
@@ -303,25 +587,76 @@ async def taginfo_command(ctx: SlashContext, tag: str) -> None:
         if split_tag[1] == "*" or "":
             del split_tag[1]
 
-    if len(split_tag) == 1:
-        await ctx.defer()
-        await ctx.send(embed=taginfo_embed(split_tag[0]))
-    elif len(split_tag) == 2:
-        await ctx.defer()
-        await ctx.send(embed=taginfo_embed(split_tag[0], split_tag[1]))
-    else:
+    if len(split_tag) not in (1, 2):
         await ctx.send("Please provide a tag.", hidden=True)
+        return
+    await ctx.defer()
+    try:
+        embed = await taginfo_embed(*split_tag)
+    except ValueError as error_message:
+        await ctx.send(str(error_message))
+        return
+    await ctx.send(embed=embed)
+
+
+### Taginfo cache ###
+# Taginfo data only changes when its database is updated (about daily), which moves `data_until` forward.
+# Entries are `(data_until, stats, wiki pages)`, so ones fetched before an update are never used after it.
+taginfo_cache = LRUCache(config["taginfo_cache"]["size"])
+taginfo_data_until: str | None = None
+taginfo_checked = 0.0
+
+
+async def check_taginfo_data_until() -> str | None:
+    """`data_until` of taginfo, checked at most every `check_interval` seconds. Pre-warms cache when it moves."""
+    global taginfo_data_until, taginfo_checked
+    if time.time() - taginfo_checked < config["taginfo_cache"]["check_interval"]:
+        return taginfo_data_until
+    taginfo_checked = time.time()
+    try:
+        sources = await http_get_json(config["taginfo_url"] + "api/4/site/sources")
+        data_until = max(source["data_until"] for source in sources)
+    except (ValueError, KeyError, TypeError):
+        return taginfo_data_until  # Keep using the last known one.
+    if data_until != taginfo_data_until:
+        taginfo_data_until = data_until
+        taginfo_cache.clear()
+        asyncio.ensure_future(prewarm_taginfo())
+    return taginfo_data_until
+
+
+async def prewarm_taginfo() -> None:
+    """Fetch most used keys and tags beforehand, one at a time to go easy on taginfo."""
+    for tag in config["taginfo_cache"]["prewarm"]:
+        try:
+            await get_taginfo(*tag.split("=", 1))
+        except ValueError:
+            pass
 
 
-def taginfo_embed(key: str, value: str | None = None) -> Embed:
+async def get_taginfo(key: str, value: str | None = None) -> tuple[dict, dict]:
+    """Stats and wiki pages of a key or tag, cached until taginfo is updated."""
+    data_until = await check_taginfo_data_until()
+    entry = taginfo_cache.get((key, value or None))
+    if entry is not None and entry[0] == data_until:
+        count("taginfo cache hit")
+        return entry[1], entry[2]
+    count("taginfo cache miss")
     if value:
-        data = requests.get(config["taginfo_url"] + f"api/4/tag/stats?key={quote(key)}&value={quote(value)}").json()
-        data_wiki = requests.get(
-            config["taginfo_url"] + f"api/4/tag/wiki_pages?key={quote(key)}&value={quote(value)}"
-        ).json()
+        path, params = "api/4/tag/", f"key={quote(key)}&value={quote(value)}"
     else:
-        data = requests.get(config["taginfo_url"] + f"api/4/key/stats?key={quote(key)}").json()
-        data_wiki = requests.get(config["taginfo_url"] + f"api/4/key/wiki_pages?key={quote(key)}").json()
+        path, params = "api/4/key/", f"key={quote(key)}"
+    data, data_wiki = await asyncio.gather(
+        http_get_json(config["taginfo_url"] + path + "stats?" + params),
+        http_get_json(config["taginfo_url"] + path + "wiki_pages?" + params),
+    )
+    taginfo_cache[(key, value or None)] = (data_until, data, data_wiki)
+    return data, data_wiki
+
+
+async def taginfo_embed(key: str, value: str | None = None) -> Embed:
+    # Data may be cached, so it mustn't be modified.
+    data, data_wiki = await get_taginfo(key, value)
 
     data_wiki_en_list = [lang for lang in data_wiki["data"] if lang["lang"] == "en"]
     data_wiki_en = data_wiki_en_list[0] if data_wiki_en_list else None
@@ -371,8 +706,7 @@ def taginfo_embed(key: str, value: str | None = None) -> Embed:
         else "*None*",
         inline=False,
     )
-    del data["data"][0]
-    for d in data["data"]:
+    for d in data["data"][1:]:
         embed.add_field(
             # This gets the emoji. Removes "s" from the end if it is there to do this.
             name=config["emoji"][d["type"] if d["type"][-1] != "s" else d["type"][:-1]] + " " + d["type"],
@@ -436,44 +770,115 @@ async def elm_command(ctx: SlashContext, elm_type: str, elm_id: str, extras: str
         return
 
     try:
-        elm = get_elm(elm_type, elm_id)
+        elm = await get_elm(elm_type, elm_id)
     except ValueError as error_message:
         await ctx.send(error_message, hidden=True)
         return
-    files = []
+    file = None
     if "map" in extras_list:
         await ctx.defer()
-        render_queue = await elms_to_render(elm_type, elm_id)
-        check_rate_limit(ctx.author_id, extra=len(render_queue) ** rendering_rate_exp)
-        bbox = get_render_queue_bounds(render_queue)
-        zoom, lat, lon = calc_preview_area(bbox)
-        cluster, filename, errors = await get_image_cluster(lat, lon, zoom)
-        cached_files.add(filename)
-        cluster, filename2 = render_elms_on_cluster(cluster, render_queue, (zoom, lat, lon))
-        cached_files.add(filename2)
+        preview_key = preview_cache_key([elm])
+        data = preview_cache.get(preview_key)
+        count("preview cache hit" if data is not None else "preview cache miss")
+        if data is None:
+            try:
+                render_queue = await elms_to_render(elm_type, elm_id)
+                check_rate_limit(ctx.author_id, extra=render_queue.ways ** rendering_rate_exp)
+                bbox = get_render_queue_bounds(render_queue)
+                zoom, lat, lon = calc_preview_area(bbox)
+                data, errors, degraded = await render_map((zoom, lat, lon), render_queue)
+            except ValueError as error_message:
+                await ctx.send(str(error_message))
+                return
+            if not errors and not degraded:  # Don't keep maps with missing or blurry tiles.
+                preview_cache[preview_key] = data
+        file = map_file(data)
     embed = elm_embed(elm, extras_list)
-    file = None
-    if "map" in extras_list:
-        print("attachment://" + filename2.split("/")[-1])
-        embed.set_image(url="attachment://" + filename2.split("/")[-1])
-        file = File(filename2)
+    if file is not None:
+        embed.set_image(url="attachment://" + file.filename)
     await ctx.send(embed=embed, file=file)
 
 
-def get_elm(elm_type: str, elm_id: str | int, suffix: str = "") -> dict:
-    res = requests.get(config["api_url"] + f"api/0.6/{elm_type}/{elm_id}.json" + suffix)
-    code = res.status_code
+async def get_elm(elm_type: str, elm_id: str | int, suffix: str = "") -> dict:
+    elm = get_cached_object(elm_type, (str(elm_id), suffix))
+    if elm is not None:
+        return elm
+    code, body = await http_get(config["api_url"] + f"api/0.6/{elm_type}/{elm_id}.json" + suffix)
     if code == 410:
         raise ValueError(f"{elm_type.capitalize()} `{elm_id}` has been deleted.")
     elif code == 404:
         raise ValueError(f"{elm_type.capitalize()} `{elm_id}` has never existed.")
     try:
-        elm = res.json()["elements"][0]
+        elm = json.loads(body)["elements"][0]
     except (json.decoder.JSONDecodeError, IndexError, KeyError):
         raise ValueError(f"{elm_type.capitalize()} `{elm_id}` was not found.")
+    cache_object(elm_type, (str(elm_id), suffix), elm, object_ttl(elm_type, elm, discussion=bool(suffix)))
+    remember_usernames(usernames_in(elm))
     return elm
 
 
+def chunk_ids(ids: list[int], max_length: int = 1800) -> list[list[int]]:
+    """Split IDs into chunks, that joined with commas are at most max_length characters long."""
+    # Keeps multi-fetch URLs safely under usual 2000 character limit.
+    chunks: list[list[int]] = [[]]
+    length = 0
+    for elm_id in ids:
+        if chunks[-1] and length + len(str(elm_id)) > max_length:
+            chunks.append([])
+            length = 0
+        chunks[-1].append(elm_id)
+        length += len(str(elm_id)) + 1
+    return [chunk for chunk in chunks if chunk]
+
+
+async def get_elms(
+    elm_type: str, elm_ids: Iterable[str | int]
+) -> tuple[dict[int, dict], list[tuple[str, int, ValueError]]]:
+    """Fetch many elements of same type using multi-fetch API. Returns found elements by ID and errorlog."""
+    ids = list(dict.fromkeys(int(elm_id) for elm_id in elm_ids))
+    found: dict[int, dict] = {}
+    errorlog = []
+    users = []  # Saved all at once, one commit instead of one per element.
+    for elm_id in ids:
+        elm = get_cached_object(elm_type, (str(elm_id), ""))
+        if elm is not None:
+            found[elm_id] = elm
+    for chunk in chunk_ids([elm_id for elm_id in ids if elm_id not in found]):
+        url = config["api_url"] + f"api/0.6/{elm_type}s.json?{elm_type}s=" + ",".join(map(str, chunk))
+        try:
+            code, body = await http_get(url)
+        except ValueError as error_message:
+            # Server is down or too slow, asking for each element separately would only make it worse.
+            errorlog += [(elm_type, elm_id, error_message) for elm_id in chunk]
+            continue
+        if code == 200:
+            try:
+                for elm in json.loads(body)["elements"]:
+                    found[elm["id"]] = elm
+                    if elm.get("visible") is not False:  # Deleted ones would be served to get_elm later.
+                        cache_object(elm_type, (str(elm["id"]), ""), elm, object_ttl(elm_type, elm))
+                    users += usernames_in(elm)
+                continue
+            except (json.decoder.JSONDecodeError, KeyError):
+                pass
+        # Whole request fails if any element in it never existed, fetching one by one finds out which one.
+        for elm_id in chunk:
+            try:
+                found[elm_id] = await get_elm(elm_type, elm_id)
+            except ValueError as error_message:
+                errorlog.append((elm_type, elm_id, error_message))
+    if users:
+        remember_usernames(users)
+    for elm_id in ids:
+        if found.get(elm_id, {}).get("visible") is False:
+            # Unlike single element lookup, multi-fetch returns deleted elements too.
+            del found[elm_id]
+            errorlog.append((elm_type, elm_id, ValueError(f"{elm_type.capitalize()} `{elm_id}` has been deleted.")))
+        elif elm_id not in found and not any(error[1] == elm_id for error in errorlog):
+            errorlog.append((elm_type, elm_id, ValueError(f"{elm_type.capitalize()} `{elm_id}` was not found.")))
+    return found, errorlog
+
+
 def elm_embed(elm: dict, extras: Iterable[str] = []) -> Embed:
     embed = Embed()
     embed.type = "rich"
@@ -637,47 +1042,44 @@ async def changeset_command(ctx: SlashContext, changeset_id: str, extras: str =
             return
 
     try:
-        changeset = get_changeset(changeset_id, "discussion" in extras)
+        changeset = await get_changeset(changeset_id, "discussion" in extras)
     except ValueError as error_message:
         await ctx.send(error_message, hidden=True)
         return
 
-    files = []
+    file = None
     if "map" in extras_list:
         await ctx.defer()
         render_queue = changeset["geometry"]
         check_rate_limit(ctx.author_id)
         bbox = get_render_queue_bounds(render_queue)
         zoom, lat, lon = calc_preview_area(bbox)
-        cluster, filename, errors = await get_image_cluster(lat, lon, zoom)
-        cached_files.add(filename)
-        cluster, filename2 = render_elms_on_cluster(cluster, render_queue, (zoom, lat, lon))
-        cached_files.add(filename2)
+        data, errors, degraded = await render_map((zoom, lat, lon), render_queue)
+        file = map_file(data)
     embed = changeset_embed(changeset, extras_list)
-    file = None
-    if "map" in extras_list:
-        print("attachment://" + filename2.split("/")[-1])
-        embed.set_image(url="attachment://" + filename2.split("/")[-1])
-        file = File(filename2)
+    if file is not None:
+        embed.set_image(url="attachment://" + file.filename)
     await ctx.send(embed=embed, file=file)
 
 
-def get_changeset(changeset_id: str | int, discussion: bool = False) -> dict:
+async def get_changeset(changeset_id: str | int, discussion: bool = False) -> dict:
     """Shorthand for `get_elm("changeset", changeset_id)`"""
     try:
         discussion_suffix = ""
         if discussion:
             discussion_suffix = "?include_discussion=true"
-        changeset = get_elm("changeset", changeset_id, discussion_suffix)
-        changeset["geometry"] = [
+        changeset = await get_elm("changeset", changeset_id, discussion_suffix)
+        changeset["geometry"] = Segments.from_lists(
             [
-                (changeset["minlat"], changeset["minlon"]),
-                (changeset["minlat"], changeset["maxlon"]),
-                (changeset["maxlat"], changeset["maxlon"]),
-                (changeset["maxlat"], changeset["minlon"]),
-                (changeset["minlat"], changeset["minlon"]),
+                [
+                    (changeset["minlat"], changeset["minlon"]),
+                    (changeset["minlat"], changeset["maxlon"]),
+                    (changeset["maxlat"], changeset["maxlon"]),
+                    (changeset["maxlat"], changeset["minlon"]),
+                    (changeset["minlat"], changeset["minlon"]),
+                ]
             ]
-        ]
+        )
         return changeset
     except ValueError as error_message:
         raise ValueError(error_message)
@@ -805,7 +1207,7 @@ async def note_command(ctx: SlashContext, note_id: str, extras: str = "") -> Non
             return
 
     try:
-        note = get_note(note_id)
+        note = await get_note(note_id)
     except ValueError as error_message:
         await ctx.send(error_message, hidden=True)
         return
@@ -814,13 +1216,19 @@ async def note_command(ctx: SlashContext, note_id: str, extras: str = "") -> Non
     await ctx.send(embed=note_embed(note, extras_list))
 
 
-def get_note(note_id: str | int) -> dict:
+async def get_note(note_id: str | int) -> dict:
     """Shorthand for get_elm didn't work"""
-    res = requests.get(config["api_url"] + f"api/0.6/notes/{note_id}.json")
+    elm = get_cached_object("note", str(note_id))
+    if elm is not None:
+        return elm
+    code, body = await http_get(config["api_url"] + f"api/0.6/notes/{note_id}.json")
     try:
-        elm = res.json()
+        elm = json.loads(body)
+        ttl = object_ttl("note", elm)
     except (json.decoder.JSONDecodeError, IndexError, KeyError):
         raise ValueError(f"Note `{note_id}` does not exist.")
+    cache_object("note", str(note_id), elm, ttl)
+    remember_usernames(usernames_in(elm))
     return elm
 
 
@@ -926,10 +1334,9 @@ async def user_command(ctx: SlashContext, username: str, extras: str = "") -> No
             return
 
     try:
-        # Both will raise ValueError if the user isn't found, get_id_from_username will usually error first.
+        # Raises ValueError if the user isn't found, usually already when looking up their uid.
         # In cases where the account was only removed recently, get_user will error.
-        user_id = get_id_from_username(username)
-        user = get_user(user_id)
+        user = await get_user_by_name(username)
     except ValueError as error_message:
         await ctx.send(error_message, hidden=True)
         return
@@ -938,27 +1345,31 @@ async def user_command(ctx: SlashContext, username: str, extras: str = "") -> No
     await ctx.send(embed=user_embed(user, extras_list))
 
 
-def get_id_from_username_old(username: str) -> int:
-    whosthat = requests.get(config["whosthat_url"] + "whosthat.php?action=names&q=" + username).json()
+async def get_id_from_username_old(username: str) -> int:
+    whosthat = await http_get_json(config["whosthat_url"] + "whosthat.php?action=names&q=" + username)
     if len(whosthat) > 0:
         return whosthat[0]["id"]
     else:
         raise ValueError(f"User `{username}` not found")
 
 
-def get_id_from_username(username: str) -> int:
-    whosthat = requests.get(config["whosthat_url"] + "whosthat.php?action=names&q=" + username).json()
+async def get_id_from_username(username: str) -> int:
+    user_id = indexed_user_id(username)
+    if user_id is not None:
+        return user_id
+    whosthat = await http_get_json(config["whosthat_url"] + "whosthat.php?action=names&q=" + username)
     if len(whosthat) > 0:
         return whosthat[0]["id"]
     # Backup solution via changesets
-    res = requests.get(config["api_url"] + f"api/0.6/changesets/?display_name={username}").text
+    res = (await http_get(config["api_url"] + f"api/0.6/changesets/?display_name={username}"))[1].decode()
     if res == "Object not found":
+        remember_missing_username(username, f"User `{username}` does not exist.")
         raise ValueError(f"User `{username}` does not exist.")
     if "uid=" in res:
         # +5 and -2 are used to isolate uid from `uid="123" `.
         return res[res.find('uid="') + 5 : res.find('user="') - 2]
     # Backup of a backup by using notes lookup.
-    res = requests.get(config["api_url"] + f"api/0.6/notes/search.json/?display_name={username}").json()
+    res = await http_get_json(config["api_url"] + f"api/0.6/notes/search.json/?display_name={username}")
     for feat in res["features"]:
         for comm in feat["properties"]["comments"]:
             try:
@@ -966,17 +1377,31 @@ def get_id_from_username(username: str) -> int:
                     return str(comm["uid"])
             except KeyError:
                 pass  # Encountered anonymous note
+    remember_missing_username(username, f"User `{username}` does exist, but has no changesets nor notes.")
     raise ValueError(f"User `{username}` does exist, but has no changesets nor notes.")
 
 
-def get_user(user_id: str | int) -> dict:
-    res = requests.get(config["api_url"] + f"api/0.6/user/{user_id}.json")
+async def get_user(user_id: str | int) -> dict:
+    user = get_cached_object("user", str(user_id))
+    if user is not None:
+        return user
+    code, body = await http_get(config["api_url"] + f"api/0.6/user/{user_id}.json")
 
     try:
-        user = res.json()["user"]
+        user = json.loads(body)["user"]
     except (json.decoder.JSONDecodeError, IndexError, KeyError):
         raise ValueError(f"User `{user_id}` not found")
 
+    cache_object("user", str(user_id), user, object_ttl("user", user))
+    remember_usernames([(user["id"], user["display_name"])])
+    return user
+
+
+async def get_user_by_name(username: str) -> dict:
+    user = await get_user(await get_id_from_username(username))
+    if user["display_name"] != username:
+        # Index had a name from before user was renamed, now it knows the new one. Look up old name again.
+        user = await get_user(await get_id_from_username(username))
     return user
 
 
@@ -1054,13 +1479,13 @@ async def showmap_command(ctx: SlashContext, url: str) -> None:
     first_msg = await ctx.send("Getting image…")
     with ctx.channel.typing():
 
-        image_file, filename, errorlog = await get_image_cluster(lat_deg, lon_deg, zoom_int)
+        data, errorlog, degraded = await render_map((zoom_int, lat_deg, lon_deg))
 
         # TODO: I probabbly need to get some better injection protection at some point.
         # This works though so eh ¯\_(ツ)_/¯
         msg = f"<{config['site_url']}#map={zoom_int}/{lat_deg}/{lon_deg}>"
 
-        img_msg = await ctx.channel.send(msg, file=File(filename))
+        img_msg = await ctx.channel.send(msg, file=map_file(data))
 
     await first_msg.edit(content=f'Getting image… Done[!](<{msg_to_link(img_msg)}> "Link to message with image") :map:')
 
@@ -1112,10 +1537,144 @@ def deg2tile_float(lat_deg: float, lon_deg: float, zoom: int) -> tuple[float, fl
     return (xtile, max(min(n - 1, ytile), 0))
 
 
+### Overpass ###
+# Overpass gives everyone few slots, queries over them are rejected. So before sending, check that a slot is free.
+# Our own queries wait in line for `parallel_queries` turns, overloaded server is retried with backoff.
+overpass_turns: asyncio.Semaphore | None = None
+overpass_queue_length = 0
+
+# Rolling average of latency and error rate of each endpoint. Queries go to the healthiest one.
+# Errors are forgotten over time, so endpoint that was down gets another chance later.
+overpass_endpoints = [config["overpass_url"]] + config["overpass"]["mirrors"]
+overpass_health = {url: {"latency": 1.0, "errors": 0.0, "updated": 0.0} for url in overpass_endpoints}
+HEALTH_SMOOTHING = 0.2
+ERROR_HALF_LIFE = 300  # seconds
+
+
+def record_overpass_health(url: str, latency: float, failed: bool) -> None:
+    health = overpass_health[url]
+    health["latency"] += HEALTH_SMOOTHING * (latency - health["latency"])
+    health["errors"] = overpass_error_rate(url) + HEALTH_SMOOTHING * (failed - overpass_error_rate(url))
+    health["updated"] = time.time()
+
+
+def overpass_error_rate(url: str) -> float:
+    health = overpass_health[url]
+    return health["errors"] * 0.5 ** ((time.time() - health["updated"]) / ERROR_HALF_LIFE)
+
+
+def overpass_endpoint(tried: set[str]) -> str:
+    """Healthiest endpoint, preferring ones that current query hasn't tried yet."""
+    candidates = [url for url in overpass_health if url not in tried] or list(overpass_health)
+    return min(candidates, key=lambda url: overpass_health[url]["latency"] * (1 + 10 * overpass_error_rate(url)))
+
+
+async def overpass_slot_wait(url: str) -> float:
+    """Seconds until Overpass has a free slot for us, according to its /status page."""
+    status_url = url.rsplit("/", 1)[0] + "/status"
+    try:
+        code, body = await http_get(status_url, headers={"Accept": "text/plain"})
+    except ValueError:
+        return 0.0  # Status is unknown, just try.
+    status = body.decode(errors="replace")
+    if code != 200 or "slots available now" in status or "Rate limit: 0" in status:
+        return 0.0
+    waits = [int(seconds) for seconds in re.findall(r"in (\d+) seconds", status)]
+    return float(min(waits)) if waits else 0.0
+
+
+@asynccontextmanager
+async def overpass_turn(status_msg: Message | None = None):
+    """Wait for one of our `parallel_queries` turns. It's held only while query is actually running on server."""
+    global overpass_turns, overpass_queue_length
+    if overpass_turns is None:
+        overpass_turns = asyncio.Semaphore(config["overpass"]["parallel_queries"])
+    if overpass_turns.locked() and status_msg:
+        position = overpass_queue_length + 1
+        await status_msg.edit(content=f"{LOADING_EMOJI} Waiting for Overpass, position {position} in queue.")
+    overpass_queue_length += 1
+    try:
+        await overpass_turns.acquire()
+    finally:
+        overpass_queue_length -= 1
+    try:
+        yield
+    finally:
+        overpass_turns.release()
+
+
+async def _overpass_query(Q: str, status_msg: Message | None = None) -> overpy.Result:
+    # Whole query, including waiting and retries, must fit into `deadline`, user won't wait longer anyway.
+    deadline = time.time() + config["overpass"]["deadline"]
+    retries = config["overpass"]["retries"]
+    tried: set[str] = set()
+    code, error = None, "out of time"
+    for attempt in range(retries + 1):
+        url = overpass_endpoint(tried)
+        tried.add(url)
+        host = urlsplit(url).netloc
+        wait = min(await overpass_slot_wait(url), config["overpass"]["max_slot_wait"])
+        if time.time() + wait >= deadline:
+            code, error = None, "out of time"
+            break
+        if wait > 0:
+            count("overpass slot wait")
+            if status_msg:
+                await status_msg.edit(content=f"{LOADING_EMOJI} Waiting {round(wait)} s for free Overpass slot.")
+            await asyncio.sleep(wait)
+        async with overpass_turn(status_msg):
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                code, error = None, "out of time"
+                break
+            start = time.time()
+            try:
+                # Just above server side [timeout:45] of our queries, so hung endpoint is given up on soon.
+                timeout = aiohttp.ClientTimeout(total=min(config["overpass"]["timeout"], remaining))
+                async with get_http_session().post(url, data={"data": Q}, timeout=timeout) as res:
+                    code, body = res.status, await res.read()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                # Endpoint is down or didn't make it in time, another one might.
+                code, error = None, e.__class__.__name__
+            record_overpass_health(url, time.time() - start, code is None or code == 429 or code >= 500)
+        if code == 200:
+            count("overpass served by " + host)
+            print(f"Overpass query served by {host}.")
+            # Parsing large relations takes a while, so it's done in separate thread.
+            # Raises overpy.exception.OverpassRuntimeError if query ran out of time or memory.
+            return await asyncio.to_thread(overpass_api.parse_json, body)
+        elif code is not None and code < 500 and code != 429:
+            raise ValueError(f"Overpass rejected the query ({code}).")
+        count("overpass failed at " + host)
+        print(f"Overpass query failed at {host} ({code or error}).")
+        if attempt < retries and not [url for url in overpass_health if url not in tried]:
+            # Every endpoint is busy, wait before going through them again.
+            # Without jitter, all waiting queries would hit the overloaded server at the same time again.
+            tried = set()
+            delay = random.uniform(0, config["overpass"]["retry_delay"] * 2 ** attempt)
+            if time.time() + delay >= deadline:
+                code, error = None, "out of time"
+                break
+            if status_msg:
+                await status_msg.edit(content=f"{LOADING_EMOJI} Overpass is busy, retrying in {round(delay)} s.")
+            await asyncio.sleep(delay)
+    if code is None:
+        raise ValueError(f"Request to Overpass failed ({error}).")
+    elif code == 429:
+        raise ValueError("Overpass is too busy right now, please try again later.")
+    raise overpy.exception.OverpassGatewayTimeout()
+
+
+async def overpass_query(Q: str, status_msg: Message | None = None) -> overpy.Result:
+    """Run Overpass query, sharing result with identical queries that are already running."""
+    # Result objects are only read after this, so they can be safely shared.
+    with timed("overpass query"):
+        return await single_flight(("overpass", Q), _overpass_query, Q, status_msg)
+
+
 async def elms_to_render(
     elem_type,
     elem_id,
-    no_reduction=False,
     get_bbox=False,
     recursion_depth=0,
     status_msg: Message | None = None,
@@ -1146,24 +1705,34 @@ async def elms_to_render(
     else:
         output_type = "skel geom"  # Original version
     Q = "[out:json][timeout:45];" + elem_type + "(id:" + str(elem_id) + ");out " + output_type + ";"
+    if elem_type == "way":
+        # Nodes of way are needed too, otherwise overpy queries them separately.
+        Q += "node(w);out skel;"
+    elif elem_type == "relation" and output_type == "skel geom":
+        # Sub-relations are fetched in the same query.
+        Q = "[out:json][timeout:45];" + relation_tree_query([elem_id])
     if status_msg:
         await status_msg.edit(
             content=f"{LOADING_EMOJI} Querying `" + Q + "`"
         )  # I hope this works. uncomment on live instance
     # Above line may introduce error when running it from /element, not on_message.
     try:
-        result = overpass_api.query(Q)
-    except exception.OverpassRuntimeError:
+        result = await overpass_query(Q, status_msg)
+    except (overpy.exception.OverpassRuntimeError, overpy.exception.OverpassGatewayTimeout):
+        # Query was too heavy, bounding box or center of relation is much less work.
         print("Overpass timeout")
         if not get_bbox:
             # recursion_depth is not increased, because this is retry of same element
-            return await elms_to_render(elem_type, elem_id, no_reduction, True, recursion_depth, status_msg=status_msg)
+            return await elms_to_render(elem_type, elem_id, True, recursion_depth, status_msg=status_msg)
         else:
             Q = Q.replace("bb;", "skel center;")
             get_center = True
             if status_msg:
                 await status_msg.edit(content=f"{LOADING_EMOJI} Querying `" + Q + "`")
-            result = overpass_api.query(Q)
+            try:
+                result = await overpass_query(Q, status_msg)
+            except (overpy.exception.OverpassRuntimeError, overpy.exception.OverpassGatewayTimeout):
+                raise ValueError(f"Overpass couldn't get geometry of {elem_type} `{elem_id}` in time.")
     # return result
     # Since we are querying for single element, top level result will have just 1 element.
     node_count = 0
@@ -1172,148 +1741,328 @@ async def elms_to_render(
     if get_center:
         if "center" in result.relations[0].attributes:
             center = result.relations[0].attributes["center"]
-            return [[(float(center["lat"]), float(center["lon"]))]]
+            return Segments.from_lists([[(float(center["lat"]), float(center["lon"]))]], approximate=True)
     elif get_bbox:
         if "bounds" in result.relations[0].attributes:
             bound = result.relations[0].attributes["bounds"]
             # {'minlat': Decimal('59.4'), 'minlon': Decimal('24.6'), 'maxlat': Decimal('59.5'), 'maxlon': Decimal('24.7')
-            return [
+            return Segments.from_lists(
                 [
-                    (float(bound["minlat"]), float(bound["minlon"])),
-                    (float(bound["minlat"]), float(bound["maxlon"])),
-                    (float(bound["maxlat"]), float(bound["maxlon"])),
-                    (float(bound["maxlat"]), float(bound["minlon"])),
-                    (float(bound["minlat"]), float(bound["minlon"])),
-                ]
-            ]
+                    [
+                        (float(bound["minlat"]), float(bound["minlon"])),
+                        (float(bound["minlat"]), float(bound["maxlon"])),
+                        (float(bound["maxlat"]), float(bound["maxlon"])),
+                        (float(bound["maxlat"]), float(bound["minlon"])),
+                        (float(bound["minlat"]), float(bound["minlon"])),
+                    ]
+                ],
+                approximate=True,
+            )
     if elem_type == "relation":
-        segments = []
-        elems = result.relations[0].members
-        prev_last = None
-        for i in range(len(elems)):
-            # Previously it skipped elements based on role, but it was buggy.
-            # New, recursive approach.
-            if type(elems[i]) == overpy.RelationRelation:
-                seg = await elms_to_render(
-                    "relation", elems[i].ref, True, get_bbox, recursion_depth + 1, status_msg=status_msg
-                )
-                segments += seg
-            elif type(elems[i]) == overpy.RelationNode:  # Single node as member of relation
-                segments.append([(float(elems[i].attributes["lat"]), float(elems[i].attributes["lon"]))])
-            elif type(elems[i]) == overpy.RelationWay:
-                geom = elems[i].geometry
-                segments.append(list(map(lambda x: (float(x.lat), float(x.lon)), geom)))
+        relations = {relation.id: relation for relation in result.relations}
+        segments = elm_segments(relations[int(elem_id)], relations)
     elif elem_type == "way":
-        elems = result.ways[0]
-        segments = [
-            list(map(lambda x: (float(x.lat), float(x.lon)), elems.get_nodes(True)))
-        ]  # True means resolving node references.
+        segments = elm_segments(result.ways[0])
     elif elem_type == "node":
-        # Creates simply a single-node segment.
-        segments = [[(float(result.nodes[0].lat), float(result.nodes[0].lon))]]
+        segments = elm_segments(result.nodes[0])
     else:  # If encountered unknown element type.
-        return []
-    if no_reduction:
-        return segments
-    # segments=merge_segments(segments)
-    segments = reduce_segment_nodes(segments)
+        return Segments()
+    # Segments are simplified once zoom of the map is known, see project_render_queue.
+    segments = unique_segments(segments)
+    segments = Segments.from_lists(merge_segments(segments), ways=len(segments))
     # We now have list of lists of (lat, lon) coordinates to be rendered.
     # These lists of segments can be joined, if multiple elements are requested
     # In order to add support for colours, just create segment-colour pairs.
     return segments
 
 
-def merge_segments(segments: list[list[tuple[float, float]]]) -> list[list[tuple[float, float]]]:
-    # Other bug occurs in case some ways of relation are reversed.
-    # Ideally, this should merge two segments, if they share same end and beginning node.
-    # Merges some ways together. For russia, around 4000 ways became 34 segments.
+### Geometry ###
+class Segments:
+    """Lines to be drawn: one flat float64 array of (lat, lon) rows and offsets where each segment starts.
+    Lists of tuples take around hundred bytes per coordinate, this takes 16.
+    Approximate segments are only bounding box or center of element, that was too big to query in full.
+    `ways` is number of segments before they were merged into longer lines, rendering quota is based on it."""
+
+    def __init__(
+        self,
+        coords: np.ndarray | None = None,
+        offsets: np.ndarray | None = None,
+        approximate: bool = False,
+        ways: int | None = None,
+    ) -> None:
+        self.coords = np.empty((0, 2)) if coords is None else coords
+        self.offsets = np.empty(0, dtype=np.int64) if offsets is None else offsets
+        self.approximate = approximate
+        self.ways = len(self.offsets) if ways is None else ways
+
+    @classmethod
+    def from_lists(
+        cls, segments: Iterable[Iterable[tuple[float, float]]], approximate: bool = False, ways: int | None = None
+    ) -> Segments:
+        segments = [segment if isinstance(segment, (list, tuple)) else list(segment) for segment in segments]
+        segments = [segment for segment in segments if segment]  # Every segment has at least one point.
+        lengths = [len(segment) for segment in segments]
+        # Straight from coordinates to array, without building any lists on the way.
+        points = itertools.chain.from_iterable(itertools.chain.from_iterable(segments))
+        coords = np.fromiter(points, dtype=np.float64, count=2 * sum(lengths)).reshape(-1, 2)
+        return cls(coords, np.cumsum([0] + lengths[:-1], dtype=np.int64) if lengths else None, approximate, ways)
+
+    @classmethod
+    def concat(cls, parts: Iterable[Segments]) -> Segments:
+        parts = [part for part in parts if len(part)]
+        if not parts:
+            return cls()
+        starts = np.cumsum([0] + [len(part.coords) for part in parts[:-1]])
+        return cls(
+            np.concatenate([part.coords for part in parts]),
+            np.concatenate([part.offsets + start for part, start in zip(parts, starts)]),
+            any(part.approximate for part in parts),
+            sum(part.ways for part in parts),
+        )
 
-    # first = (float(geom[0].lat), float(geom[0].lon))
-    # last = (float(geom[-1].lat), float(geom[-1].lon))
-    # # Adding and removing elements is faster at end of list
-    # if first in seg_ends:
-    #     # Append current segment to end of existing one
-    #     segments[seg_ends[first]] += geom[1:]
-    #     seg_ends[last] = seg_ends[first]
-    #     del seg_ends[first]
-    # elif last in seg_ends:
-    #     # Append current segment to beginning of existing one
-    #     segments[seg_ends[last]] += geom[:-1]
-    #     seg_ends[first] = seg_ends[last]
-    #     del seg_ends[last]
-    # else:
-    #     # Create new segment
-    #     segments.append(geom)
-    #     seg_ends[last] = len(segments) - 1
-    #     seg_ends[first] = len(segments) - 1
-    return segments
+    def __len__(self) -> int:
+        return len(self.offsets)
+
+    def __iter__(self):
+        """Each segment as (n, 2) view into the coordinate buffer."""
+        return iter(np.split(self.coords, self.offsets[1:]) if len(self) else [])
+
+    def tolist(self) -> list[list[tuple[float, float]]]:
+        return [list(map(tuple, segment.tolist())) for segment in self]
 
 
-def reduce_segment_nodes(segments: list[list[tuple[float, float]]]) -> list[list[tuple[float, float]]]:
-    # Relative simple way to reduce nodes by just picking every n-th node.
-    # Ignores ways with less than 50 nodes.
-    # Excel equivalent is =IF(A1<50;A1;SQRT(A1-50)+50)
-    Limiter_offset = 50  # Minimum number of nodes.
-    Reduction_factor = 2  # n-th root by which array length is reduced.
-    calc_limit = (
-        lambda x: x if x < Limiter_offset else int((x - Limiter_offset) ** (1 / Reduction_factor) + Limiter_offset)
+def relation_tree_query(relation_ids: Iterable[str | int]) -> str:
+    """Overpass statements to get relations together with their sub-relations and sub-sub-relations.
+    Only centers of sub-sub-relations are needed, deeper levels are never drawn."""
+    return (
+        "relation(id:" + ",".join(map(str, relation_ids)) + ")->.r0;rel(r.r0)->.r1;rel(r.r1)->.r2;"
+        "(.r0;.r1;)->.near;(.r2; - .near;)->.far;.near out skel geom;.far out skel center;"
     )
-    for seg_num in range(len(segments)):
-        segment = segments[seg_num]  # For each segment
-        seg_len = len(segment)
-        limit = calc_limit(seg_len)  # Get number of nodes allowed
-        step = seg_len / limit  # Average number of nodes to be skipped
-        position = 0
-        temp_array = []
-        while position < seg_len:  # Iterates over segment
-            temp_array.append(segment[int(position)])  # And select only every step-th node
-            position += step  # Using int(position) because step is usually float.
-        if int(position - step) != seg_len - 1:  # Always keep last node,
-            temp_array.append(segment[-1])  # But only if it's not added already.
-        # Convert overpy-node-objects into (lat, lon) pairs.
-        try:
-            segments[seg_num] = list(map(lambda x: (float(x.lat), float(x.lon)), temp_array))
-        except AttributeError:
-            pass  # Encountered relation node, see ln 794
-    reduced = list(map(list, set(map(tuple, segments))))
-    print(len(segments), len(reduced))
+
+
+def relation_center(relation: overpy.Relation) -> list[tuple[float, float]]:
+    if "center" in relation.attributes:
+        center = relation.attributes["center"]
+        return [(float(center["lat"]), float(center["lon"]))]
+    # Relation was fetched with geometry, middle of it's members' bounding box will do.
+    points = [point for segment in elm_segments(relation, max_depth=0) for point in segment]
+    if not points:
+        return []
+    lats, lons = [lat for lat, lon in points], [lon for lat, lon in points]
+    return [((min(lats) + max(lats)) / 2, (min(lons) + max(lons)) / 2)]
+
+
+def elm_segments(
+    elm: overpy.Element,
+    relations: dict[int, overpy.Relation] = {},
+    depth: int = 0,
+    visited: set[int] | None = None,
+    max_depth: int = 1,
+) -> list[list[tuple[float, float]]]:
+    """Segments of element from `out skel geom` query.
+    Sub-relations come from `relations`, ones deeper than max_depth are drawn as their center."""
+    if isinstance(elm, overpy.Relation):
+        # Each relation is drawn once, which also stops cycles.
+        visited = visited if visited is not None else set()
+        visited.add(elm.id)
+        segments = []
+        for member in elm.members:
+            if isinstance(member, overpy.RelationRelation):
+                if member.ref in visited or member.ref not in relations:
+                    continue
+                if depth < max_depth:
+                    segments += elm_segments(relations[member.ref], relations, depth + 1, visited, max_depth)
+                else:
+                    visited.add(member.ref)
+                    segments.append(relation_center(relations[member.ref]))
+            elif isinstance(member, overpy.RelationNode):  # Single node as member of relation
+                segments.append([(float(member.attributes["lat"]), float(member.attributes["lon"]))])
+            elif isinstance(member, overpy.RelationWay):
+                segments.append(list(map(lambda x: (float(x.lat), float(x.lon)), member.geometry)))
+        return [segment for segment in segments if segment]
+    elif isinstance(elm, overpy.Way):
+        # True means resolving node references.
+        return [list(map(lambda x: (float(x.lat), float(x.lon)), elm.get_nodes(True)))]
+    elif isinstance(elm, overpy.Node):
+        # Creates simply a single-node segment.
+        return [[(float(elm.lat), float(elm.lon))]]
+    return []
+
+
+async def elms_geometry(
+    elms: list[tuple[str, int]], status_msg: Message | None = None
+) -> tuple[list[Segments], list[tuple[str, int, ValueError]]]:
+    """Segments of each element, fetched with one Overpass query for all of them, and errorlog."""
+    if not elms:
+        return [], []
+    ids = {t: sorted({elm_id for elm_type, elm_id in elms if elm_type == t}) for t in ("node", "way", "relation")}
+    Q = "[out:json][timeout:45];"
+    if ids["node"] or ids["way"]:
+        Q += "(" + "".join(f"{t}(id:{','.join(map(str, ids[t]))});" for t in ("node", "way") if ids[t])
+        Q += ");out skel geom;"
+    if ids["way"]:
+        # Nodes of ways are needed too, otherwise overpy queries them separately for each way.
+        Q += "way(id:" + ",".join(map(str, ids["way"])) + ");node(w);out skel;"
+    if ids["relation"]:
+        Q += relation_tree_query(ids["relation"])
+    if status_msg:
+        await status_msg.edit(content=f"{LOADING_EMOJI} Querying `" + Q + "`")
+    try:
+        result = await overpass_query(Q, status_msg)
+    except ValueError as error_message:
+        return [Segments() for elm in elms], [(elm_type, elm_id, error_message) for elm_type, elm_id in elms]
+    except (overpy.exception.OverpassRuntimeError, overpy.exception.OverpassGatewayTimeout):
+        # Too much for a single query. One by one, large relations can fall back to their bounding boxes.
+        print("Overpass timeout")
+        results = await gather_bounded(
+            *(catch_lookup_error(t, elm_id, elms_to_render(t, elm_id, status_msg=status_msg)) for t, elm_id in elms)
+        )
+        geometries = [segments or Segments() for segments, errors in results]
+        return geometries, [error for _, errors in results for error in errors]
+    relations = {relation.id: relation for relation in result.relations}
+    found = {("node", elm.id): elm for elm in result.nodes}
+    found.update((("way", elm.id), elm) for elm in result.ways)
+    found.update((("relation", elm_id), relations[elm_id]) for elm_id in ids["relation"] if elm_id in relations)
+    geometries = []
+    errorlog = []
+    for elm_type, elm_id in elms:
+        if (elm_type, elm_id) in found:
+            segments = elm_segments(found[(elm_type, elm_id)], relations)
+            segments = unique_segments(segments)
+            geometries.append(Segments.from_lists(merge_segments(segments), ways=len(segments)))
+        else:
+            geometries.append(Segments())
+            errorlog.append((elm_type, elm_id, ValueError(f"{elm_type.capitalize()} `{elm_id}` was not found.")))
+    return geometries, errorlog
+
+
+def join_chains(a: deque, b: deque) -> deque:
+    """Join two chains of points that share an end point. Shorter one is moved onto longer one."""
+    if len(a) < len(b):
+        a, b = b, a
+    if a[-1] == b[0]:
+        b.popleft()
+        a.extend(b)
+    elif a[-1] == b[-1]:  # Reversed
+        b.pop()
+        a.extend(reversed(b))
+    elif a[0] == b[-1]:
+        b.pop()
+        a.extendleft(reversed(b))
+    else:  # a[0] == b[0], reversed
+        b.popleft()
+        a.extendleft(b)
+    return a
+
+
+def merge_segments(segments: list[list[tuple[float, float]]]) -> list[list[tuple[float, float]]]:
+    # Merges segments together, if they share same end and beginning node. Works with reversed ways too.
+    # Merges some ways together. For russia, around 4000 ways became 34 segments.
+    chains: dict[int, deque] = {}
+    seg_ends: dict[tuple[float, float], int] = {}  # Open end point → chain that ends there
+    for seg_num, segment in enumerate(segments):
+        chain = deque(segment)
+        if len(chain) > 1:
+            for end in (chain[0], chain[-1]):
+                other_num = seg_ends.get(end)
+                if other_num is None:
+                    continue
+                other = chains.pop(other_num)
+                for other_end in (other[0], other[-1]):
+                    if seg_ends.get(other_end) == other_num:
+                        del seg_ends[other_end]
+                chain = join_chains(chain, other)
+            if chain[0] != chain[-1]:  # Closed rings can't be continued
+                # Where 3 or more ways meet, only one of them can continue.
+                seg_ends.setdefault(chain[0], seg_num)
+                seg_ends.setdefault(chain[-1], seg_num)
+        chains[seg_num] = chain
+    return [list(chain) for chain in chains.values()]
+
+
+def unique_segments(segments: list[list[tuple[float, float]]]) -> list[list[tuple[float, float]]]:
+    # Same way can be in relation many times, like in both directions of a route. It's enough to draw it once.
     # with elms_to_render('relation','908054')
     # Result:  15458 vs 6564
-    return reduced
+    return list(map(list, dict.fromkeys(map(tuple, segments))))
+
+
+def simplify_line(points: np.ndarray, tolerance: float) -> np.ndarray:
+    """Douglas-Peucker: drop points that are closer than tolerance to line between points that are kept."""
+    if len(points) < 3:
+        return points
+    keep = np.zeros(len(points), dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        start = points[first]
+        inner = points[first + 1 : last] - start
+        dx, dy = points[last] - start
+        length = math.hypot(dx, dy)
+        if length == 0:  # Closed ring, measure distance from it's start instead.
+            distances = np.hypot(inner[:, 0], inner[:, 1])
+        else:
+            distances = np.abs(dx * inner[:, 1] - dy * inner[:, 0]) / length
+        farthest = int(distances.argmax())
+        if distances[farthest] > tolerance:
+            middle = first + 1 + farthest
+            keep[middle] = True
+            stack += [(first, middle), (middle, last)]
+    return points[keep]
+
+
+def clip_line(points: np.ndarray, box: tuple[float, float, float, float]) -> list[np.ndarray]:
+    """Cut polyline of (x, y) rows to parts that are inside box (xmin, ymin, xmax, ymax).
+    Every edge is clipped at once with Liang-Barsky, then edges sharing a vertex inside box are joined again."""
+    xmin, ymin, xmax, ymax = box
+    x, y = points[:, 0], points[:, 1]
+    if ((x >= xmin) & (x <= xmax) & (y >= ymin) & (y <= ymax)).all():
+        return [points]
+    if len(points) == 1:
+        return []
+    start, delta = points[:-1], np.diff(points, axis=0)
+    t0, t1 = np.zeros(len(delta)), np.ones(len(delta))
+    for p, q in (
+        (-delta[:, 0], start[:, 0] - xmin),
+        (delta[:, 0], xmax - start[:, 0]),
+        (-delta[:, 1], start[:, 1] - ymin),
+        (delta[:, 1], ymax - start[:, 1]),
+    ):
+        with np.errstate(divide="ignore", invalid="ignore"):
+            r = q / p
+        t0 = np.where(p < 0, np.maximum(t0, r), t0)
+        t1 = np.where(p > 0, np.minimum(t1, r), t1)
+        t1 = np.where((p == 0) & (q < 0), -1, t1)  # Parallel to this side and outside of it.
+    visible = t0 <= t1
+    if not visible.any():
+        return []
+    # Edge continues previous part if previous edge is visible and they meet inside box.
+    joined = np.zeros(len(delta), dtype=bool)
+    joined[1:] = visible[:-1] & (t1[:-1] == 1) & (t0[1:] == 0)
+    edges = np.flatnonzero(visible)
+    part = np.cumsum(~joined[edges]) - 1
+    firsts = np.flatnonzero(~joined[edges])
+    # Each part is its clipped first point, followed by end points of all its edges.
+    out = np.empty((len(edges) + len(firsts), 2))
+    out[np.arange(len(edges)) + part + 1] = start[edges] + t1[edges, None] * delta[edges]
+    out[firsts + np.arange(len(firsts))] = start[edges[firsts]] + t0[edges[firsts], None] * delta[edges[firsts]]
+    return np.split(out, (firsts + np.arange(len(firsts)))[1:])
 
 
 def get_render_queue_bounds(
-    segments: list[list[tuple[float, float]]], notes: list[tuple[float, float, bool]] = []
+    segments: Segments, notes: list[tuple[float, float, bool]] = []
 ) -> tuple[float, float, float, float]:
     # Finds bounding box of rendering queue (segments)
     # Rendering queue is bunch of coordinates that was calculated in previous function.
     min_lat, max_lat, min_lon, max_lon = 90.0, -90.0, 180.0, -180.0
     precision = 5  # https://xkcd.com/2170/
-    for segment in segments:
-        for coordinates in segment:
-            lat, lon = coordinates
-            # int() because type checker is an idiot
-            # Switching it to int kills the whole renderer!
-            if lat > max_lat:
-                max_lat = round(lat, precision)
-            if lat < min_lat:
-                min_lat = round(lat, precision)
-            if lon > max_lon:
-                max_lon = round(lon, precision)
-            if lon < min_lon:
-                min_lon = round(lon, precision)
-    for note in notes:
-        lat, lon, solved = note
-        # int() because type checker is an idiot
-        # Switching it to int kills the whole renderer!
-        if lat > max_lat:
-            max_lat = round(lat, precision)
-        if lat < min_lat:
-            min_lat = round(lat, precision)
-        if lon > max_lon:
-            max_lon = round(lon, precision)
-        if lon < min_lon:
-            min_lon = round(lon, precision)
+    coords = np.concatenate((segments.coords, np.array([note[:2] for note in notes], dtype=float).reshape(-1, 2)))
+    if len(coords):
+        min_lat, min_lon = np.round(coords.min(axis=0), precision).tolist()
+        max_lat, max_lon = np.round(coords.max(axis=0), precision).tolist()
     if min_lat == max_lat:  # In event when all coordinates are same...
         min_lat -= 10 ** (-precision)
         max_lat += 10 ** (-precision)
@@ -1351,38 +2100,6 @@ def calc_preview_area(queue_bounds: tuple[float, float, float, float]) -> tuple[
     return (zoom, center_lat, center_lon)
 
 
-async def get_image_cluster_old(
-    lat_deg: float,
-    lon_deg: float,
-    zoom: int,
-    tile_url: str = config["tile_url"],
-) -> File:
-    # Modified from https://github.com/ForgottenHero/mr-maps
-    delta_long = 0.00421 * math.pow(2, max_zoom - int(zoom))
-    delta_lat = 0.0012 * math.pow(2, max_zoom - int(zoom))
-    lat_deg = float(lat_deg) - (delta_lat / 2)
-    lon_deg = float(lon_deg) - (delta_long / 2)
-    i = 0
-    j = 0
-    xmin, ymax = deg2tile(lat_deg, lon_deg, zoom)
-    xmax, ymin = deg2tile(lat_deg + delta_lat, lon_deg + delta_long, zoom)
-    Cluster = Image.new("RGB", ((xmax - xmin + 1) * tile_w - 1, (ymax - ymin + 1) * tile_h - 1))
-    for xtile in range(xmin, xmax + 1):
-        for ytile in range(ymin, ymax + 1):
-            try:
-                res = requests.get(tile_url.format(zoom=zoom, x=xtile, y=ytile), headers=HEADERS)
-                tile = Image.open(BytesIO(res.content))
-                Cluster.paste(tile, box=((xtile - xmin) * tile_w, (ytile - ymin) * tile_h))
-                i = i + 1
-            except Exception as e:
-                print(e)
-        j = j + 1
-    filename = config["map_save_file"].format(t=time.time())
-    Cluster.save(filename)
-    # return File(filename)
-    return Cluster
-
-
 def get_image_tile_range(lat_deg: float, lon_deg: float, zoom: int) -> tuple[int, int, int, int, tuple[float, float]]:
     # Following line is duplicataed at calc_preview_area()
     center_x, center_y = deg2tile_float(lat_deg, lon_deg, zoom)
@@ -1404,9 +2121,211 @@ def get_image_tile_range(lat_deg: float, lon_deg: float, zoom: int) -> tuple[int
     return xmin, xmax - 1, ymin, ymax - 1, tile_offset
 
 
+def get_visible_tiles(tile_range: tuple[int, int, int, int, tuple[float, float]], zoom: int) -> list[tuple[int, int]]:
+    """Tiles (x, y) that end up at least partly on the output image."""
+    # X isn't wrapped around -180/180 meridian here, because it's needed for placing tile on image.
+    xmin, xmax, ymin, ymax, tile_offset = tile_range
+    n = 2 ** zoom  # N is number of tiles in one direction on zoom level
+    width, height = tiles_x * tile_w - 1, tiles_y * tile_h - 1
+    visible = []
+    # Range is bit wider than needed, tiles are filtered by where tile2pixel would actually put them.
+    for xtile in range(xmin - 2, xmin + tiles_x + 3):
+        for ytile in range(max(ymin - 2, 0), min(ymin + tiles_y + 3, n)):
+            x, y = tile2pixel((xtile, ytile), zoom, tile_range)
+            if x < width and x + tile_w > 0 and y < height and y + tile_h > 0:
+                visible.append((xtile, ytile))
+    return visible
+
+
+### Tile cache ###
+# Same tiles get requested over and over (city centres, repeated map fragments), so they are kept in
+# memory and on disk. Cached tile is tuple of (data, expires, etag), where expires is unix time.
+tile_memory_cache = LRUCache(config["tile_cache"]["memory_tiles"])
+tile_disk_index: OrderedDict[str, int] = OrderedDict()  # Path → size in bytes, least recently used first.
+tile_disk_size = 0
+
+
+def load_tile_disk_index() -> None:
+    """Find tiles saved on disk by previous runs of the bot."""
+    global tile_disk_size
+    found = []
+    os.makedirs(config["tile_cache"]["folder"], exist_ok=True)
+    for root, dirs, files in os.walk(config["tile_cache"]["folder"]):
+        for name in files:
+            path = os.path.join(root, name)
+            stat = os.stat(path)
+            found.append((stat.st_mtime, path, stat.st_size))
+    for mtime, path, size in sorted(found):
+        tile_disk_index[path] = size
+        tile_disk_size += size
+
+
+def tile_cache_path(tile_url: str, zoom: int, x: int, y: int) -> str:
+    # Each tile server gets it's own folder, so changing tile_url in config won't mix up tiles.
+    server = hashlib.sha1(tile_url.encode()).hexdigest()[:12]
+    return os.path.join(config["tile_cache"]["folder"], server, str(zoom), str(x), f"{y}.tile")
+
+
+def read_tile_file(path: str) -> tuple[bytes, float, str | None] | None:
+    try:
+        # First line of file is metadata, rest is tile image itself.
+        with open(path, "rb") as file:
+            meta, data = file.read().split(b"\n", 1)
+        meta = json.loads(meta)
+    except (OSError, ValueError):
+        return None
+    return data, meta["expires"], meta["etag"]
+
+
+async def read_cached_tile(key: tuple[str, int, int, int]) -> tuple[bytes, float, str | None] | None:
+    tile = tile_memory_cache.get(key)
+    if tile is not None:
+        return tile
+    path = tile_cache_path(*key)
+    if path not in tile_disk_index:
+        return None
+    # Same as writing, reading from disk happens in a thread.
+    tile = await asyncio.to_thread(read_tile_file, path)
+    if tile is None:
+        return None
+    tile_memory_cache[key] = tile
+    if path in tile_disk_index:  # Might have been evicted while reading.
+        tile_disk_index.move_to_end(path)
+    return tile
+
+
+def write_tile_file(path: str, blob: bytes) -> bool:
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as file:
+            file.write(blob)
+        return True
+    except OSError as e:
+        print(e)
+        return False
+
+
+async def store_cached_tile(key: tuple[str, int, int, int], tile: tuple[bytes, float, str | None]) -> None:
+    global tile_disk_size
+    tile_memory_cache[key] = tile
+    data, expires, etag = tile
+    blob = json.dumps({"expires": expires, "etag": etag}).encode() + b"\n" + data
+    path = tile_cache_path(*key)
+    # Disk is slow compared to everything else here, so writing happens in a thread.
+    if not await asyncio.to_thread(write_tile_file, path, blob):
+        return
+    tile_disk_size += len(blob) - tile_disk_index.pop(path, 0)
+    tile_disk_index[path] = len(blob)
+    # Remove least recently used tiles until cache fits into it's limit again.
+    while tile_disk_size > config["tile_cache"]["disk_megabytes"] * 2 ** 20 and len(tile_disk_index) > 1:
+        old_path, size = tile_disk_index.popitem(last=False)
+        tile_disk_size -= size
+        try:
+            os.remove(old_path)
+        except OSError:
+            pass
+
+
+def tile_expiry(headers) -> float | None:
+    """Unix time until which tile can be used without asking the server again. None if it must not be cached."""
+    cache_control = headers.get("Cache-Control", "").lower()
+    if "no-store" in cache_control:
+        return None
+    if "no-cache" in cache_control:
+        return 0.0  # Can be cached, but must be revalidated using ETag every time.
+    max_age = re.search(r"max-age=(\d+)", cache_control)
+    if max_age:
+        return time.time() + int(max_age[1])
+    if "Expires" in headers:
+        try:
+            return parsedate_to_datetime(headers["Expires"]).timestamp()
+        except (TypeError, ValueError):
+            return 0.0
+    return time.time() + config["tile_cache"]["default_ttl"]
+
+
+async def get_tile(session: aiohttp.ClientSession, tile_url: str, zoom: int, x: int, y: int) -> bytes:
+    """Get tile image, from cache if possible."""
+    return await single_flight(("tile", tile_url, zoom, x, y), _get_tile, session, tile_url, zoom, x, y)
+
+
+async def _get_tile(session: aiohttp.ClientSession, tile_url: str, zoom: int, x: int, y: int) -> bytes:
+    key = (tile_url, zoom, x, y)
+    tile = await read_cached_tile(key)
+    if tile is not None and tile[1] > time.time():
+        count("tile cache hit")
+        return tile[0]
+    count("tile cache miss")
+    headers = {}  # Session already sends HEADERS.
+    if tile is not None and tile[2]:
+        headers["If-None-Match"] = tile[2]
+    try:
+        with timed("tile fetch"):
+            async with session.get(tile_url.format(zoom=zoom, x=x, y=y), headers=headers) as res:
+                if res.status == 304 and tile is not None:
+                    count("tile revalidated")
+                    data = tile[0]  # Not modified, only expiry gets updated.
+                else:
+                    res.raise_for_status()
+                    data = await res.read()
+                expires = tile_expiry(res.headers)
+                etag = res.headers.get("ETag", tile[2] if tile is not None else None)
+    except aiohttp.ClientError:
+        count("tile fetch error")
+        if tile is not None:
+            return tile[0]  # Outdated tile is still better than black square.
+        raise
+    if expires is not None:
+        await store_cached_tile(key, (data, expires, etag))
+    return data
+
+
+def scale_up_tile(data: bytes, zoom_diff: int, x: int, y: int) -> bytes:
+    """Crop part of lower zoom tile that covers it's descendant x, y and scale it up to full tile size."""
+    image = Image.open(BytesIO(data)).convert("RGB")
+    part_w, part_h = image.size[0] / 2 ** zoom_diff, image.size[1] / 2 ** zoom_diff
+    image = image.crop((round(x * part_w), round(y * part_h), round((x + 1) * part_w), round((y + 1) * part_h)))
+    buffer = BytesIO()
+    image.resize((tile_w, tile_h), Image.BILINEAR).save(buffer, "PNG", compress_level=1)
+    return buffer.getvalue()
+
+
+def scale_down_tiles(children: list[bytes]) -> bytes:
+    """Join four higher zoom tiles (top-left, top-right, bottom-left, bottom-right) into one tile."""
+    image = Image.new("RGB", (tile_w * 2, tile_h * 2))
+    for i, data in enumerate(children):
+        image.paste(Image.open(BytesIO(data)), ((i % 2) * tile_w, (i // 2) * tile_h))
+    buffer = BytesIO()
+    image.resize((tile_w, tile_h), Image.LANCZOS).save(buffer, "PNG", compress_level=1)
+    return buffer.getvalue()
+
+
+async def get_fallback_tile(tile_url: str, zoom: int, x: int, y: int) -> bytes | None:
+    """Make replacement for tile that failed to download from cached tiles of other zoom levels, if there are any."""
+    # Outdated tiles are fine here, because anything is better than a black square.
+    # First try zooming into lower zoom tile.
+    for zoom_diff in range(1, min(max_fallback_zoom_diff, zoom) + 1):
+        ancestor = await read_cached_tile((tile_url, zoom - zoom_diff, x >> zoom_diff, y >> zoom_diff))
+        if ancestor is not None:
+            mask = 2 ** zoom_diff - 1
+            return await run_in_render_pool(scale_up_tile, ancestor[0], zoom_diff, x & mask, y & mask)
+    # Then try zooming out of higher zoom tiles.
+    if zoom < max_zoom:
+        children = [
+            await read_cached_tile((tile_url, zoom + 1, 2 * x + dx, 2 * y + dy)) for dy in (0, 1) for dx in (0, 1)
+        ]
+        if all(child is not None for child in children):
+            return await run_in_render_pool(scale_down_tiles, [child[0] for child in children])
+    return None
+
+
+load_tile_disk_index()
+
+
 async def _get_image_cluster__get_image(
     session: aiohttp.ClientSession,
-    cluster: Image,
+    tiles: list[tuple[tuple[int, int], bytes, str]],
+    fallbacks: list[str],
     zoom: int,
     tile_url: str,
     xtile: int,
@@ -1417,21 +2336,31 @@ async def _get_image_cluster__get_image(
     url = tile_url.format(zoom=zoom, x=xtile_corrected, y=ytile)
     # print(f"Requesting: {url}")
     try:
-        res = await session.get(url, headers=HEADERS)
-        data = await res.content.read()
-        cluster.paste(
-            Image.open(BytesIO(data)),
-            tile2pixel((xtile, ytile), zoom, tile_range),
-        )
+        data = await get_tile(session, tile_url, zoom, xtile_corrected, ytile)
+        # Decoding and pasting happens later in render pool.
+        tiles.append((tile2pixel((xtile, ytile), zoom, tile_range), data, url))
         return None
     except Exception as e:
         print(e)
-        return ("map tile", url, e)
+        try:
+            data = await get_fallback_tile(tile_url, zoom, xtile_corrected, ytile)
+        except Exception as fallback_error:
+            print(fallback_error)
+            data = None
+        if data is None:
+            return ("map tile", url, e)
+        print(f"Using cached tiles of other zoom levels instead of {url}")
+        count("tile fallback")
+        fallbacks.append(url)
+        tiles.append((tile2pixel((xtile, ytile), zoom, tile_range), data, url))
+        return None
 
 
 async def get_image_cluster(
     lat_deg: float, lon_deg: float, zoom: int, tile_url: str = config["tile_url"]
-) -> tuple[Any, str, list[tuple[str, str, Exception]]]:
+) -> tuple[list[tuple[tuple[int, int], bytes, str]], list[tuple[str, str, Exception]], list[str]]:
+    """Download tiles around given point.
+    Returns list of (pixel position, tile data, url), errorlog and urls of tiles made from other zoom levels."""
     # Rewrite of https://github.com/ForgottenHero/mr-maps
     # Following line is duplicataed at calc_preview_area()
     n: int = 2 ** zoom  # N is number of tiles in one direction on zoom level
@@ -1442,38 +2371,37 @@ async def get_image_cluster(
     xmin, xmax, ymin, ymax, tile_offset = tile_range
 
     errorlog = []
-    cluster = Image.new("RGB", (tiles_x * tile_w - 1, tiles_y * tile_h - 1))
+    tiles: list[tuple[tuple[int, int], bytes, str]] = []
+    fallbacks: list[str] = []
 
     t = time.time()
-    async with aiohttp.ClientSession() as session:
-        tasks = []
-        for xtile in range(xmin - 1, xmax + 2):
-            # print(xtile, xtile % n)
-            xtile_corrected = xtile % n  # Repeats tiles across -180/180 meridian.
-            # Xtile is preserved, because it's used for plotting it on map
-            for ytile in range(ymin, min([ymax + 2, n])):
-                tasks.append(
-                    _get_image_cluster__get_image(
-                        session,
-                        cluster,
-                        zoom,
-                        tile_url,
-                        xtile,
-                        ytile,
-                        xtile_corrected,
-                        tile_range,
-                    )
-                )
-        errors = await asyncio.gather(*tasks, return_exceptions=True)
+    session = get_http_session()
+    tasks = []
+    for xtile, ytile in get_visible_tiles(tile_range, zoom):
+        # print(xtile, xtile % n)
+        xtile_corrected = xtile % n  # Repeats tiles across -180/180 meridian.
+        # Xtile is preserved, because it's used for plotting it on map
+        tasks.append(
+            _get_image_cluster__get_image(
+                session,
+                tiles,
+                fallbacks,
+                zoom,
+                tile_url,
+                xtile,
+                ytile,
+                xtile_corrected,
+                tile_range,
+            )
+        )
+    errors = await asyncio.gather(*tasks, return_exceptions=True)
 
-        for err in errors:
-            if err is not None:
-                errorlog.append(err)
+    for err in errors:
+        if err is not None:
+            errorlog.append(err)
 
-    print(f"Download + paste: {round(time.time()-t, 1)}s")
-    filename: str = config["map_save_file"].format(t=time.time())
-    cluster.save(filename)
-    return cluster, filename, errorlog
+    print(f"Download: {round(time.time()-t, 1)}s")
+    return tiles, errorlog, fallbacks
 
 
 def draw_line(segment: list[tuple[float, float]], draw, colour="red") -> None:
@@ -1508,6 +2436,23 @@ def wgs2pixel(
     return tile2pixel(coord, zoom, tile_range)
 
 
+def wgs2pixels(
+    coords: np.ndarray,
+    tile_range: tuple[int, int, int, int, tuple[float, float]],
+    frag: tuple[int, float, float],
+) -> np.ndarray:
+    """Convert array of (lat, lon) rows to (x, y) pixels on map. Like wgs2pixel, but all at once and unrounded."""
+    n = 2 ** frag[0]
+    xmin, xmax, ymin, ymax, tile_offset = tile_range
+    lat, lon = coords[:, 0], coords[:, 1]
+    xtile = (lon + 180.0) / 360 * n
+    # Same safety bounds on vertical tile range as in deg2tile_float.
+    lat_rad = np.radians(np.clip(lat, -89, 89))
+    ytile = np.clip((1 - np.log(np.tan(lat_rad) + (1 / np.cos(lat_rad))) / np.pi) / 2 * n, 0, n - 1)
+    ytile = np.where(lat >= 89, 0, np.where(lat <= -89, n - 1, ytile))
+    return np.column_stack(((xtile - xmin - tile_offset[0]) * tile_w, (ytile - ymin - tile_offset[1]) * tile_h))
+
+
 def tile2pixel(xy, zoom, tile_range):
     """Convert Z/X/Y tile to map's X-Y coordinates"""
     # That's all, no complex math involved. Rendering bug might be somewhere else.
@@ -1517,75 +2462,233 @@ def tile2pixel(xy, zoom, tile_range):
     return coord
 
 
-def render_notes_on_cluster(Cluster, notes: list[tuple[float, float, bool]], frag: tuple[int, float, float], filename):
-    # tile_offset - By how many tiles should tile grid shifted somewhere.
+def project_render_queue(render_queue: Segments, frag: tuple[int, float, float]) -> list[list[tuple[int, int]]]:
+    """Convert [[(lat, lon), ...], ...] to pixel coordinates on map centered at frag.
+    Lines are clipped to the map and points that wouldn't make visible difference on map are dropped."""
+    if not render_queue:
+        return []
     tile_range = get_image_tile_range(frag[1], frag[2], frag[0])
-    errorlog = []
-    for note in notes:
-        # TODO: Unify coordinate conversion functions.
-        coord = wgs2pixel(note, tile_range, frag)
-        # print(coord)
-        if note[2]:  # If note is closed
+    # All points are projected at once, then split back into segments.
+    pixels = wgs2pixels(render_queue.coords, tile_range, frag)
+    margin = config["render_clip_margin"]  # Enough for line width and node circles on the edge to stay whole.
+    box = (-margin, -margin, tiles_x * tile_w + margin, tiles_y * tile_h + margin)
+    # Extent of every segment, from the flat buffer in one go.
+    low, high = np.minimum.reduceat(pixels, render_queue.offsets), np.maximum.reduceat(pixels, render_queue.offsets)
+    lengths = np.diff(np.append(render_queue.offsets, len(pixels)))
+    on_map = (high[:, 0] >= box[0]) & (low[:, 0] <= box[2]) & (high[:, 1] >= box[1]) & (low[:, 1] <= box[3])
+    # Ways smaller than a pixel are covered by their neighbours anyway, but nodes are always drawn.
+    visible = on_map & (((high - low).max(axis=1) >= 1) | (lengths == 1))
+    lines = []
+    for segment, keep in zip(Segments(pixels, render_queue.offsets), visible):
+        if not keep:
+            continue
+        for part in clip_line(segment, box):
+            part = simplify_line(part, config["simplify_tolerance"])
+            lines.append(list(map(tuple, np.round(part).astype(int).tolist())))
+    print(
+        f"Kept {visible.sum()} of {len(render_queue)} segments, "
+        f"simplified {len(render_queue.coords)} points to {sum(map(len, lines))}."
+    )
+    return lines
+
+
+def project_notes(
+    notes: list[tuple[float, float, bool]], frag: tuple[int, float, float]
+) -> list[tuple[int, int, bool]]:
+    """Convert [(lat, lon, solved), ...] to pixel coordinates on map centered at frag."""
+    if not notes:
+        return []
+    tile_range = get_image_tile_range(frag[1], frag[2], frag[0])
+    pixels = np.round(wgs2pixels(np.array([note[:2] for note in notes], dtype=float), tile_range, frag)).astype(int)
+    return [(x, y, note[2]) for (x, y), note in zip(pixels.tolist(), notes)]
+
+
+def render_notes_on_cluster(Cluster, notes: list[tuple[int, int, bool]]):
+    # Inputs:   Cluster - PIL image
+    #           notes - [(x, y, solved), ...] in pixels, see project_notes
+    for x, y, solved in notes:
+        if solved:  # If note is closed
             note_icon = closed_note_icon
-            icon_pos = (int(coord[0] - closed_note_icon_size[0] / 2), int(coord[1] - closed_note_icon_size[1]))
+            icon_pos = (int(x - closed_note_icon_size[0] / 2), int(y - closed_note_icon_size[1]))
         else:
             note_icon = open_note_icon
-            icon_pos = (int(coord[0] - open_note_icon_size[0] / 2), int(coord[1] - open_note_icon_size[1]))
+            icon_pos = (int(x - open_note_icon_size[0] / 2), int(y - open_note_icon_size[1]))
         # https://stackoverflow.com/questions/5324647
         # print(icon_pos)
         Cluster.paste(note_icon, icon_pos, note_icon)
         del note_icon
-    Cluster.save(filename)
-    return Cluster, filename
+    return Cluster
 
 
-def render_elms_on_cluster(Cluster, render_queue: list[list[tuple[float, float]]], frag: tuple[int, float, float]):
+def render_elms_on_cluster(Cluster, lines: list[list[tuple[int, int]]], center: tuple[int, int] | None = None):
     # Inputs:   Cluster - PIL image
-    #           render_queue - [[(lat, lon), ...], ...]
-    #           frag  - zoom, lat, lon used  for cluster rendering input.
-    # Renderer requires epsg 3587 crs converter. Implemented in deg2tile_float.
-    # Use solution similar to get_image_cluster, but use deg2tile_float function to get xtile/ytile.
-    # I think tile calculation should be separate from get_image_cluster.
-    # tile_offset - By how many tiles should tile grid shifted somewhere.
-    # tile_range = xmin, xmax, ymin, ymax, tile_offset
-    tile_range = get_image_tile_range(frag[1], frag[2], frag[0])
-    # Convert geographical coordinates to X-Y coordinates to be used on map.
+    #           lines - [[(x, y), ...], ...] in pixels, see project_render_queue
+    #           center  - where center of map fragment ended up in pixels, for debugging alignment.
     draw = ImageDraw.Draw(Cluster)  # Not sure what it does, just following https://stackoverflow.com/questions/59060887
     # Basic demo for colour picker.
     len_colors = len(element_colors)
-    for seg_num in range(len(render_queue)):
-        for i in range(len(render_queue[seg_num])):
-            render_queue[seg_num][i] = wgs2pixel(render_queue[seg_num][i], tile_range, frag)
+    for seg_num in range(len(lines)):
         # Draw segment onto image
         color = element_colors[seg_num % len_colors]
-        draw_line(render_queue[seg_num], draw, color)
+        draw_line(lines[seg_num], draw, color)
         # Maybe nodes shouldn't be rendered, if way has many, let's say 80+ nodes,
         # because it would become too cluttered?  This is very indecisive function.
         draw_nodes = False
-        if len(render_queue[seg_num]) < 80:
+        if len(lines[seg_num]) < 80:
             draw_nodes = True
-        if len(render_queue) > 40:
+        if len(lines) > 40:
             draw_nodes = False
-        if len(render_queue[seg_num]) == 1:
+        if len(lines[seg_num]) == 1:
             draw_nodes = True
         if draw_nodes:
-            draw_node(render_queue[seg_num][0], draw, color)
-            if len(render_queue[seg_num]) > 1:
-                for node_num in range(1, len(render_queue[seg_num])):
-                    draw_node(render_queue[seg_num][node_num], draw, color)
-    filename = config["map_save_file"].format(t=time.time())
-    if True:
+            draw_node(lines[seg_num][0], draw, color)
+            if len(lines[seg_num]) > 1:
+                for node_num in range(1, len(lines[seg_num])):
+                    draw_node(lines[seg_num][node_num], draw, color)
+    if center is not None:
         draw_node((640.0, 640.0), draw, "#088")
-        coord = wgs2pixel((frag[1], frag[2]), tile_range, frag)
-        print("Map alignment error: ", coord[0] - 640, coord[1] - 640)
-        draw_node(coord, draw, "#bb0")
-        print(640, 640, " ", *coord)
-    print(f"Saved drawn image as {filename}.")
-    Cluster.save(filename)
-    return Cluster, filename
+        draw_node(center, draw, "#bb0")
+    return Cluster
     # I barely know how to draw lines in PIL
 
 
+def render_map_image(
+    tiles: list[tuple[tuple[int, int], bytes, str]],
+    lines: list[list[tuple[int, int]]],
+    notes: list[tuple[int, int, bool]],
+    center: tuple[int, int] | None = None,
+) -> tuple[bytes, list[tuple[str, str, str]], float]:
+    """Decode and stitch tiles, draw elements and notes onto them and encode the result.
+
+    This runs in render pool, so inputs are plain tile data and geometry already projected to pixels.
+    Returns encoded image, errorlog of tiles that failed to decode and time spent on encoding."""
+    errorlog = []
+    cluster = Image.new("RGB", (tiles_x * tile_w - 1, tiles_y * tile_h - 1))
+    for pos, data, url in tiles:
+        try:
+            cluster.paste(Image.open(BytesIO(data)), pos)
+        except Exception as e:
+            print(e)
+            errorlog.append(("map tile", url, str(e)))
+    if lines:
+        render_elms_on_cluster(cluster, lines, center)
+    if notes:
+        render_notes_on_cluster(cluster, notes)
+    t = time.time()
+    data = encode_map_image(cluster)
+    return data, errorlog, time.time() - t
+
+
+def encode_map_image(image: Image.Image) -> bytes:
+    """Encode finished map in format set by config["map_output"]."""
+    output = config["map_output"]
+    buffer = BytesIO()
+    if output["format"] == "png":
+        if output["png_palette_colours"]:
+            # Map tiles don't use many colours anyway, so this is barely visible, but file gets much smaller.
+            image = image.quantize(output["png_palette_colours"], method=Image.FASTOCTREE)
+        image.save(buffer, "PNG", compress_level=output["png_compress_level"])
+    elif output["format"] == "webp":
+        image.save(buffer, "WEBP", quality=output["quality"])
+    elif output["format"] == "jpeg":
+        image.save(buffer, "JPEG", quality=output["quality"])
+    else:
+        raise ValueError(f"Unknown map output format `{output['format']}`.")
+    return buffer.getvalue()
+
+
+### Render pool ###
+# PIL work is CPU-heavy and would block the event loop, so it's done in separate processes.
+render_pool: Any = None  # multiprocessing.pool.Pool
+
+
+def get_render_pool():
+    """Render pool is created at startup, before client.run, while this process has no other threads yet.
+    Forking later could copy a lock held by some other thread into worker and deadlock it.
+    Workers inherit all functions of this module."""
+    global render_pool
+    if render_pool is None:
+        render_pool = Pool(config["render_workers"])  # null in config means one per CPU.
+    return render_pool
+
+
+async def run_in_render_pool(func, *args):
+    """Run func(*args) in render pool without blocking the event loop."""
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def set_result(result) -> None:
+        if not future.done():  # Caller might have been cancelled meanwhile.
+            future.set_result(result)
+
+    def set_exception(error: BaseException) -> None:
+        if not future.done():
+            future.set_exception(error)
+
+    get_render_pool().apply_async(
+        func,
+        args,
+        callback=lambda result: loop.call_soon_threadsafe(set_result, result),
+        error_callback=lambda error: loop.call_soon_threadsafe(set_exception, error),
+    )
+    try:
+        # If worker dies, pool never calls back.
+        return await asyncio.wait_for(future, config["render_timeout"])
+    except asyncio.TimeoutError:
+        count("render timeout")
+        raise ValueError("Rendering map took too long.")
+
+
+async def render_map(
+    frag: tuple[int, float, float],
+    render_queue: Segments = Segments(),
+    notes: list[tuple[float, float, bool]] = [],
+    status_msg: Message | None = None,
+) -> tuple[bytes, list[tuple[str, str, Exception | str]], bool]:
+    """Render map fragment with elements and notes drawn on it. Returns encoded image, errorlog and
+    whether map is degraded: made of tiles from other zoom levels or showing only approximate geometry."""
+    zoom, lat, lon = frag
+    with timed("render: tiles"):
+        tiles, errorlog, fallbacks = await get_image_cluster(lat, lon, zoom)
+    with timed("render: projection"):
+        lines = project_render_queue(render_queue, frag)
+        note_pixels = project_notes(notes, frag)
+    center = None
+    if render_queue:
+        center = wgs2pixel((lat, lon), get_image_tile_range(lat, lon, zoom), frag)
+        print("Map alignment error: ", center[0] - 640, center[1] - 640)
+    if status_msg and (render_queue or notes):
+        await status_msg.edit(content=f"{LOADING_EMOJI} Rendering elements to map.")
+    t = time.time()
+    data, errors, encode_time = await run_in_render_pool(render_map_image, tiles, lines, note_pixels, center)
+    record_latency("render: draw + encode", time.time() - t)
+    record_latency("render: encode", encode_time)
+    count("rendered kB", round(len(data) / 1024))
+    print(f"Paste + render: {round(time.time()-t, 1)}s")
+    print(f"Encoded {round(len(data) / 1024)} kB {config['map_output']['format']} in {round(encode_time, 2)}s")
+    return data, errorlog + errors, bool(fallbacks) or render_queue.approximate
+
+
+def map_file(data: bytes) -> File:
+    """Wrap rendered map into file ready to be uploaded to Discord."""
+    extension = {"png": "png", "webp": "webp", "jpeg": "jpg"}[config["map_output"]["format"]]
+    return File(BytesIO(data), filename="map." + extension)
+
+
+### Preview cache ###
+# Rendering big relations takes tens of seconds, but their map only changes together with their version.
+preview_cache = LRUCache(config["preview_cache_size"])
+
+
+def preview_cache_key(elms: Iterable[dict]) -> tuple:
+    """Key of rendered map that shows exactly these elements (as returned by get_elm)."""
+    return (
+        frozenset((elm["type"], elm["id"], elm["version"]) for elm in elms),
+        (tiles_x * tile_w - 1, tiles_y * tile_h - 1),
+        tuple(sorted(config["map_output"].items())),
+    )
+
+
 element_action_row = manage_components.create_actionrow(
     manage_components.create_button(
         style=ButtonStyle.blue, emoji=INSPECT_EMOJI, label="Element info", custom_id="elm_embed"
@@ -1666,8 +2769,6 @@ async def on_raw_reaction_add(payload: discord.RawReactionActionEvent):
 
 @client.event  # type: ignore
 async def on_message(msg: Message) -> None:
-    global cached_files
-
     if msg.author == client.user:
         return
 
@@ -1756,12 +2857,13 @@ async def on_message(msg: Message) -> None:
     if len(elms + notes + changesets) != 0:
         ask_confirmation = True
     add_embedded = True
+    add_image = False
     wait_for_user_start = time.time()
     if ask_confirmation:
         add_image, add_embedded = await ask_render_confirmation(msg)
         print(add_image)
     wait_for_user_end = time.time()
-    render_queue: list[list[tuple[float, float]]] = []
+    render_queue = Segments()
     # User quota is checked after they confirmed element lookup.
     for i in range(int(queried_elements_count ** element_count_exp) + 1):
         # Allows querying up to 10 elements at same time, delayed for up to 130 sec
@@ -1777,58 +2879,77 @@ async def on_message(msg: Message) -> None:
         files: list[File] = []
         errorlog = []
 
-        for elm_type, elm_ids, separator in elms:
-            for elm_id in elm_ids:
-                await status_msg.edit(content=f"{LOADING_EMOJI} Processing {elm_type}/{elm_id}.")
-                try:
-                    if add_embedded:
-                        embeds.append(elm_embed(get_elm(elm_type, elm_id)))
-                    if add_image:
-                        render_queue += await elms_to_render(elm_type, elm_id, status_msg=status_msg)
-                except ValueError as error_message:
-                    errorlog.append((elm_type, elm_id, error_message))
-
-        for elm_type, changeset_ids, separator in changesets:
-            # changeset_ids = (<tuple: list of changesets>, <str: separator used>)
-            for changeset_id in changeset_ids:
-                await status_msg.edit(content=f"{LOADING_EMOJI} Processing {elm_type}/{changeset_id}.")
-                try:
-                    changeset = get_changeset(changeset_id)
-                    if add_embedded:
-                        embeds.append(changeset_embed(changeset))
-                    if add_image:
-                        render_queue += changeset["geometry"]
-                except ValueError as error_message:
-                    errorlog.append((elm_type, changeset_id, error_message))
+        # All lookups and map fragments run at the same time, results are put together in order of the message.
+        # Elements of same type are fetched together.
+        requested_elms = [(elm_type, int(elm_id)) for elm_type, elm_ids, separator in elms for elm_id in elm_ids]
+        elm_types = list(dict.fromkeys(elm_type for elm_type, elm_id in requested_elms))
+        changeset_ids = [(elm_type, elm_id) for elm_type, elm_ids, separator in changesets for elm_id in elm_ids]
+        note_ids = [(elm_type, elm_id) for elm_type, elm_ids, separator in notes for elm_id in elm_ids]
+        lookups = [
+            [get_elms(elm_type, [elm_id for t, elm_id in requested_elms if t == elm_type]) for elm_type in elm_types],
+            [catch_lookup_error(elm_type, elm_id, get_changeset(elm_id)) for elm_type, elm_id in changeset_ids],
+            [catch_lookup_error(elm_type, elm_id, get_note(elm_id)) for elm_type, elm_id in note_ids],
+            [catch_lookup_error("user", username, get_user_by_name(username)) for username in users],
+            [catch_lookup_error("map", map_frag, render_map(frag_to_bits(map_frag))) for map_frag in map_frags],
+        ]
+        await status_msg.edit(content=f"{LOADING_EMOJI} Processing {queried_elements_count} links.")
+        results = iter(await gather_bounded(*(lookup for group in lookups for lookup in group)))
+        elm_results, changeset_results, note_results, user_results, frag_results = (
+            [next(results) for lookup in group] for group in lookups
+        )
+        for result, errors in elm_results + changeset_results + note_results + user_results + frag_results:
+            errorlog += errors
+
+        fetched_elms: dict[tuple[str, int], dict] = {}
+        for elm_type, (found, errors) in zip(elm_types, elm_results):
+            fetched_elms.update(((elm_type, elm_id), elm) for elm_id, elm in found.items())
+        found_elms = [fetched_elms[elm] for elm in requested_elms if elm in fetched_elms]
+        found_changesets = [changeset for changeset, errors in changeset_results if changeset is not None]
+        found_notes = [note for note, errors in note_results if note is not None]
+        if add_embedded:
+            embeds += [elm_embed(elm) for elm in found_elms]
+            embeds += [changeset_embed(changeset) for changeset in found_changesets]
+            embeds += [note_embed(note) for note in found_notes]
+
+        # Versions of elements are known now, so their map might be already rendered.
+        # Changesets and notes can change without version, so maps with them are never cached.
+        preview_key = None
+        cached_preview = None
+        geometry_complete = True
+        if add_image and found_elms and not changesets and not notes:
+            preview_key = preview_cache_key(found_elms)
+            cached_preview = preview_cache.get(preview_key)
+            count("preview cache hit" if cached_preview is not None else "preview cache miss")
+        if add_image and cached_preview is None:
+            # All elements are queried together, saving Overpass quota.
+            geometries, errors = await elms_geometry([(elm["type"], elm["id"]) for elm in found_elms], status_msg)
+            render_queue = Segments.concat([render_queue, *geometries])
+            errorlog += errors
+            # Map missing some of elements must not be served later as map of all of them.
+            geometry_complete = not errors and all(geometries)
 
         notes_render_queue = []
-        for elm_type, note_ids, separator in notes:
-            # note_ids = (<tuple: list of notes>, <str: separator used>)
-            for note_id in note_ids:
-                await status_msg.edit(content=f"{LOADING_EMOJI} Processing {elm_type}/{note_id}.")
-                try:
-                    note = get_note(note_id)
-                    if add_embedded:
-                        embeds.append(note_embed(note))
-                    if add_image:
-                        notes_render_queue.append(
-                            (
-                                note["geometry"]["coordinates"][1],
-                                note["geometry"]["coordinates"][0],
-                                note["properties"]["status"] == "closed",
-                            )
-                        )
-                except ValueError as error_message:
-                    errorlog.append((elm_type, note_id, error_message))
+        if add_image:
+            render_queue = Segments.concat([render_queue] + [changeset["geometry"] for changeset in found_changesets])
+            for note in found_notes:
+                notes_render_queue.append(
+                    (
+                        note["geometry"]["coordinates"][1],
+                        note["geometry"]["coordinates"][0],
+                        note["properties"]["status"] == "closed",
+                    )
+                )
         time_spent = round(time.time() - msg_arrived - (wait_for_user_end - wait_for_user_start), 3)
         if time_spent > 15:
             # Most direct way to assess difficulty of user's request.
             check_rate_limit(author_id, time_spent)
         print(f"Script spent {time_spent} sec on downloading elements.")
         msg_arrived = time.time()
-        if render_queue or notes_render_queue:
+        if cached_preview is not None:
+            files.append(map_file(cached_preview))
+        elif render_queue or notes_render_queue:
             # Add extra to quota for querying large relations
-            check_rate_limit(author_id, extra=(len(render_queue) + len(notes_render_queue)) ** rendering_rate_exp)
+            check_rate_limit(author_id, extra=(render_queue.ways + len(notes_render_queue)) ** rendering_rate_exp)
             # Next step is to calculate map area for render.
             await status_msg.edit(content=f"{LOADING_EMOJI} Downloading map tiles")
             bbox = get_render_queue_bounds(render_queue, notes_render_queue)
@@ -1836,54 +2957,38 @@ async def on_message(msg: Message) -> None:
             if notes_render_queue:
                 zoom = min([zoom, max_note_zoom])
             print(zoom, lat, lon, sep="/")
-            cluster, filename, errors = await get_image_cluster(lat, lon, zoom)
-            cached_files.add(filename)
-            errorlog += errors
-
-            # Start drawing elements on image.
-            if render_queue:
-                await status_msg.edit(content=f"{LOADING_EMOJI} Rendering elements to map.")
-                cluster, filename2 = render_elms_on_cluster(cluster, render_queue, (zoom, lat, lon))
-                cached_files.add(filename2)
-            else:
-                filename2 = filename
-            if notes_render_queue:
-                await status_msg.edit(content=f"{LOADING_EMOJI} Rendering notes to map.")
-                for note in notes_render_queue:
-                    cluster, filename2 = render_notes_on_cluster(
-                        cluster, notes_render_queue, (zoom, lat, lon), filename2
-                    )
-                cached_files.add(filename2)
-            files.append(File(filename2))
-
-        for username in users:
-            await status_msg.edit(content=f"{LOADING_EMOJI} Processing user/{username}.")
             try:
-                embeds.append(user_embed(get_user(get_id_from_username(username))))
+                data, errors, degraded = await render_map(
+                    (zoom, lat, lon), render_queue, notes_render_queue, status_msg
+                )
             except ValueError as error_message:
-                errorlog.append(("user", username, error_message))
-
-        for map_frag in map_frags:
-            await status_msg.edit(content=f"{LOADING_EMOJI} Processing {map_frag}.")
-            zoom, lat, lon = frag_to_bits(map_frag)
-            cluster, filename, errors = await get_image_cluster(lat, lon, zoom)
-            errorlog += errors
-            files.append(File(filename))
-            cached_files.add(filename)
+                errorlog.append(("map", bits_to_frag((zoom, lat, lon)), error_message))
+            else:
+                if preview_key is not None and geometry_complete and not errors and not degraded:
+                    preview_cache[preview_key] = data
+                errorlog += errors
+                files.append(map_file(data))
+
+        embeds += [user_embed(user) for user, errors in user_results if user is not None]
+        for rendered, errors in frag_results:
+            if rendered is not None:
+                errorlog += rendered[1]
+                files.append(map_file(rendered[0]))
         await status_msg.edit(content=f"{LOADING_EMOJI} Starting upload")
         # Send the messages
-        if len(embeds) > 0:
-            await msg.channel.send(embed=embeds[0], reference=msg)
-            for embed in embeds[1:]:
-                await msg.channel.send(embed=embed)
-            for file in files:
-                await msg.channel.send(file=file)
-
-        # Sending files is also handled in embeds messaging.
-        elif len(files) > 0:
-            await msg.channel.send(file=files[0], reference=msg)
-            for file in files[1:]:
-                await msg.channel.send(file=file)
+        with timed("discord upload"):
+            if len(embeds) > 0:
+                await msg.channel.send(embed=embeds[0], reference=msg)
+                for embed in embeds[1:]:
+                    await msg.channel.send(embed=embed)
+                for file in files:
+                    await msg.channel.send(file=file)
+
+            # Sending files is also handled in embeds messaging.
+            elif len(files) > 0:
+                await msg.channel.send(file=files[0], reference=msg)
+                for file in files[1:]:
+                    await msg.channel.send(file=file)
         await status_msg.delete()
 
         if len(errorlog) > 0:
@@ -1902,11 +3007,6 @@ async def on_message(msg: Message) -> None:
             check_rate_limit(author_id, time_spent)
         print(f"Script spent {time_spent} sec on preparing output (render, embeds, files, errors).")
 
-    # Clean up files
-    for filename in cached_files:
-        os.remove(filename)
-    cached_files = set()
-
 
 ### Member count ###
 @client.event  # type: ignore
@@ -2154,6 +3254,8 @@ if __name__ == "__main__":
     load_dotenv()
     import tests
 
+    get_render_pool()
+
     if os.getenv("TESTING") == "True":
         client.run(os.getenv("DISCORD_TESTING_TOKEN"))
     else:
@@ -20,8 +20,9 @@ def test_3():
 
 
 def test_4():
-    assert main.get_render_queue_bounds([[(0.10, 0.0)], [(0.6, 0.5)]]) == (0.1, 0.6, 0.0, 0.5)
-    assert main.get_render_queue_bounds([[(0.0, 0.0)], [(0.0, 0.0)]]) == (-1e-05, 1e-05, -1e-05, 1e-05)
+    Segments = main.Segments.from_lists
+    assert main.get_render_queue_bounds(Segments([[(0.10, 0.0)], [(0.6, 0.5)]])) == (0.1, 0.6, 0.0, 0.5)
+    assert main.get_render_queue_bounds(Segments([[(0.0, 0.0)], [(0.0, 0.0)]])) == (-1e-05, 1e-05, -1e-05, 1e-05)
 
 
 def test_5():
@@ -32,10 +33,219 @@ def test_6():
     assert main.max_note_zoom <= main.max_zoom
 
 
+def test_7():
+    # Visible tiles must cover every pixel of the output image, using at most one extra row and column of tiles.
+    width, height = main.tiles_x * main.tile_w - 1, main.tiles_y * main.tile_h - 1
+    for zoom, lat, lon in [(5, 0.0, 0.0), (10, 59.43, 24.75), (17, -33.86, 151.2), (6, 70.0, 179.9), (19, 51.5, -0.12)]:
+        tile_range = main.get_image_tile_range(lat, lon, zoom)
+        visible = main.get_visible_tiles(tile_range, zoom)
+        assert len(visible) <= (main.tiles_x + 1) * (main.tiles_y + 1)
+        columns, rows = set(), set()
+        for tile in visible:
+            x, y = main.tile2pixel(tile, zoom, tile_range)
+            columns.update(range(max(x, 0), min(x + main.tile_w, width)))
+            rows.update(range(max(y, 0), min(y + main.tile_h, height)))
+        # Visible tiles form a grid, so covering every column and row means covering every pixel.
+        assert len(visible) == len({x for x, y in visible}) * len({y for x, y in visible})
+        assert len(columns) == width and len(rows) == height
+
+
+def test_8():
+    assert main.chunk_ids([]) == []
+    assert main.chunk_ids([1, 22, 333]) == [[1, 22, 333]]
+    assert main.chunk_ids([1, 22, 333], 4) == [[1, 22], [333]]
+    assert main.chunk_ids([12345], 3) == [[12345]]
+    chunks = main.chunk_ids(list(range(10 ** 9, 10 ** 9 + 1000)))
+    assert sum(chunks, []) == list(range(10 ** 9, 10 ** 9 + 1000))
+    assert all(len(",".join(map(str, chunk))) <= 1800 for chunk in chunks)
+
+
+def test_9():
+    assert main.object_ttl("changeset", {"open": False}) is None
+    assert main.object_ttl("changeset", {"open": False}, discussion=True) is not None
+    assert main.object_ttl("changeset", {"open": True}) is not None
+    assert main.object_ttl("note", {"properties": {"status": "open"}}) is not None
+    tags = {"name": "Test"}
+    main.cache_object("node", ("1", ""), {"tags": tags}, None)
+    tags.clear()
+    main.get_cached_object("node", ("1", ""))["tags"].clear()
+    assert main.get_cached_object("node", ("1", "")) == {"tags": {"name": "Test"}}
+    main.cache_object("user", "1", {}, -1)
+    assert main.get_cached_object("user", "1") is None
+
+
+def test_10():
+    main.username_db = main.open_username_index(":memory:")
+    assert main.indexed_user_id("Alice") is None
+    main.remember_usernames(main.usernames_in({"uid": 1, "user": "Alice", "comments": [{"uid": 2, "user": "Bob"}]}))
+    assert main.indexed_user_id("Alice") == 1 and main.indexed_user_id("Bob") == 2
+    main.remember_usernames([(1, "Alicia")])  # Rename
+    assert main.indexed_user_id("Alice") is None and main.indexed_user_id("Alicia") == 1
+    main.remember_usernames([(3, "Bob")])  # Name taken over after rename
+    assert main.indexed_user_id("Bob") == 3
+    main.remember_missing_username("Carol", "User `Carol` does not exist.")
+    try:
+        main.indexed_user_id("Carol")
+        assert False
+    except ValueError:
+        pass
+    main.remember_usernames([(4, "Carol")])
+    assert main.indexed_user_id("Carol") == 4
+
+
+def test_11():
+    # Relations 1 and 2 are members of each other, relation 3 is too deep and is drawn as its center.
+    result = main.overpy.Result.from_json(
+        {
+            "elements": [
+                {"type": "relation", "id": 1, "members": [{"type": "relation", "ref": 2, "role": ""}]},
+                {
+                    "type": "relation",
+                    "id": 2,
+                    "members": [
+                        {"type": "relation", "ref": 1, "role": ""},
+                        {"type": "relation", "ref": 3, "role": ""},
+                        {"type": "node", "ref": 4, "role": "", "lat": 1.0, "lon": 2.0},
+                    ],
+                },
+                {"type": "relation", "id": 3, "center": {"lat": 3.0, "lon": 4.0}, "members": []},
+            ]
+        }
+    )
+    relations = {relation.id: relation for relation in result.relations}
+    assert main.elm_segments(relations[1], relations) == [[(3.0, 4.0)], [(1.0, 2.0)]]
+
+
+def test_12():
+    np = main.np
+    line = np.array([(x, 0.1 * (x % 2)) for x in range(100)], dtype=float)
+    assert main.simplify_line(line, 0.5).tolist() == [[0, 0], [99, 0.1]]
+    zigzag = np.array([(0, 0), (1, 5), (2, 0), (3, 5)], dtype=float)
+    assert len(main.simplify_line(zigzag, 0.5)) == 4
+    angles = np.linspace(0, 2 * np.pi, 100000)
+    ring = np.column_stack((500 + 400 * np.cos(angles), 500 + 400 * np.sin(angles)))
+    simplified = main.simplify_line(ring, 0.5)
+    assert len(simplified) < len(ring) / 10
+    assert simplified[0].tolist() == ring[0].tolist() and simplified[-1].tolist() == ring[-1].tolist()
+
+
+def test_13():
+    # Second way is reversed, third continues the first one backwards, fourth is separate.
+    ways = [[(1, 1), (2, 2)], [(3, 3), (2, 2)], [(0, 0), (1, 1)], [(5, 5), (6, 6)]]
+    merged = main.merge_segments(ways)
+    assert len(merged) == 2 and [(5, 5), (6, 6)] in merged
+    assert [(0, 0), (1, 1), (2, 2), (3, 3)] in merged or [(3, 3), (2, 2), (1, 1), (0, 0)] in merged
+    # Ring made of two ways stays closed, single nodes are kept.
+    merged = main.merge_segments([[(0, 0), (1, 0), (1, 1)], [(0, 0), (0, 1), (1, 1)], [(9, 9)]])
+    assert len(merged) == 2 and merged[0][0] == merged[0][-1] and len(merged[0]) == 5 and [(9, 9)] in merged
+
+
+def test_14():
+    # Segments keep all coordinates in one buffer
+    segments = main.Segments.from_lists([[(0.0, 1.0), (2.0, 3.0)], [(4.0, 5.0)]])
+    assert len(segments) == 2
+    assert segments.coords.shape == (3, 2)
+    assert segments.offsets.tolist() == [0, 2]
+    assert segments.tolist() == [[(0.0, 1.0), (2.0, 3.0)], [(4.0, 5.0)]]
+    joined = main.Segments.concat([segments, main.Segments(), segments])
+    assert joined.offsets.tolist() == [0, 2, 3, 5]
+    assert joined.tolist() == segments.tolist() * 2
+    assert not main.Segments() and main.Segments().tolist() == []
+    assert main.Segments.concat([segments, main.Segments.from_lists([[(0.0, 0.0)]], approximate=True)]).approximate
+    assert not joined.approximate
+    # Rendering quota counts ways that were merged together, not lines left after merging.
+    assert main.Segments.concat([main.Segments.from_lists([[(0.0, 0.0), (1.0, 1.0)]], ways=3), segments]).ways == 5
+
+
+def test_15():
+    # Clipping lines to map
+    box = (0, 0, 10, 10)
+
+    def clip(points):
+        return [part.tolist() for part in main.clip_line(main.np.array(points, dtype=float), box)]
+
+    assert clip([(1, 1), (5, 5)]) == [[[1, 1], [5, 5]]]
+    parts = clip([(-5, 5), (5, 5), (15, 5), (5, 8), (5, 20)])
+    assert parts == [[[0, 5], [5, 5], [10, 5]], [[10, 6.5], [5, 8], [5, 10]]]
+    assert clip([(20, 20), (30, 30)]) == clip([(12, 5)]) == clip([(-1, 20), (-1, -20)]) == []
+    # Far away and sub-pixel ways are dropped, nodes are kept.
+    frag = (10, 0.0, 0.0)
+    queue = main.Segments.from_lists(
+        [[(0.0, 0.0), (0.1, 0.1)], [(50.0, 50.0), (50.1, 50.1)], [(0.0, 0.0), (1e-6, 0.0)]]
+    )
+    queue = main.Segments.concat([queue, main.Segments.from_lists([[(0.0, 0.0)]])])
+    lines = main.project_render_queue(queue, frag)
+    assert len(lines) == 2 and len(lines[0]) == 2 and len(lines[1]) == 1
+
+
+def test_16():
+    # Tile expiry from response headers
+    now = main.time.time()
+    assert main.tile_expiry({"Cache-Control": "no-store"}) is None
+    assert main.tile_expiry({"Cache-Control": "no-cache"}) == 0.0
+    assert now + 99 < main.tile_expiry({"Cache-Control": "public, max-age=100"}) < now + 102
+    assert main.tile_expiry({"Expires": "Wed, 21 Oct 2015 07:28:00 GMT"}) == 1445412480.0
+    assert main.tile_expiry({"Expires": "soon"}) == 0.0
+    default_ttl = main.config["tile_cache"]["default_ttl"]
+    assert now + default_ttl - 1 < main.tile_expiry({}) < now + default_ttl + 2
+
+
+def _solid_tile(colour, size=(256, 256)):
+    buffer = main.BytesIO()
+    main.Image.new("RGB", size, colour).save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+def test_17():
+    # Fallback tiles from other zoom levels
+    parent = main.Image.new("RGB", (256, 256), "red")
+    parent.paste((0, 0, 255), (128, 128, 256, 256))  # Only bottom-right quarter is blue.
+    buffer = main.BytesIO()
+    parent.save(buffer, "PNG")
+    quarter = main.Image.open(main.BytesIO(main.scale_up_tile(buffer.getvalue(), 1, 1, 1)))
+    assert quarter.size == (256, 256) and quarter.getpixel((128, 128)) == (0, 0, 255)
+    quarter = main.Image.open(main.BytesIO(main.scale_up_tile(buffer.getvalue(), 1, 0, 0)))
+    assert quarter.getpixel((255, 255)) == (255, 0, 0)
+    colours = [(255, 0, 0), (0, 255, 0), (0, 0, 255), (255, 255, 255)]
+    joined = main.Image.open(main.BytesIO(main.scale_down_tiles([_solid_tile(colour) for colour in colours])))
+    assert joined.size == (256, 256)
+    assert [joined.getpixel(xy) for xy in ((64, 64), (192, 64), (64, 192), (192, 192))] == colours
+    # Tile 3/2/2 is missing, its children on zoom 4 are cached.
+    url = "test://{zoom}/{x}/{y}"
+    for i, colour in enumerate(colours):
+        main.tile_memory_cache[(url, 4, 4 + i % 2, 4 + i // 2)] = (_solid_tile(colour), 0.0, None)
+    run_in_render_pool = main.run_in_render_pool
+
+    async def run_directly(func, *args):
+        return func(*args)
+
+    # Tests run on every start of the bot, so no worker processes are started here.
+    main.run_in_render_pool = run_directly
+    try:
+        data = main.asyncio.run(main.get_fallback_tile(url, 3, 2, 2))
+        assert main.Image.open(main.BytesIO(data)).getpixel((192, 64)) == colours[1]
+        assert main.asyncio.run(main.get_fallback_tile(url, 3, 0, 0)) is None
+    finally:
+        main.run_in_render_pool = run_in_render_pool
+        for i in range(4):
+            del main.tile_memory_cache[(url, 4, 4 + i % 2, 4 + i // 2)]
+
+
 test_1()
 test_2()
 test_3()
 test_4()
 test_5()
 test_6()
+test_7()
+test_8()
+test_9()
+test_10()
+test_11()
+test_12()
+test_13()
+test_14()
+test_15()
+test_16()
+test_17()
 print(f"All {len(set(filter(lambda x:x[0]!='_', dir())))-1} tests passed.")